@@ -1,8 +1,12 @@
+import shared
+metrics = shared.metrics
+
 import smith_waterman as sw
 sw_nav = sw.sw_nav
 
 import external
 sudo = external.sudo
+resume = external.resume
 external.enableCopy()
 external.enableDelete()
 delete = external.delete
@@ -10,3 +14,4 @@ external.enableMkdir()
 external.enableRename()
 external.enableSymlink()
 external.enableHardlink()
+# external.enableMetrics()
@@ -2,12 +2,15 @@ import ranger.core.loader as loader
 import ranger.config.commands as commands
 
 import shared
+import shared.instrument as instrument
 
 import os
 import sys
 import subprocess as sub
 import threading
 from . import rpcss
+from . import fastcopy
+from . import fsops
 
 
 class RpcServerManager:
@@ -15,10 +18,25 @@ class RpcServerManager:
     provides a rpc server.
 
     if necessary, spawns a subprocess hosting a rpc client.
+    the transport (see rpcss.TRANSPORTS) defaults to SudoTransport or Transport.
+
+    if not interactive, sudo won't ask for a password.
+    if Timeout is not None, it is sent to the client (see rpcss.RpcClient).
     '''
 
-    def __init__(self, sudo=False):
+    Transport = 'plain'
+    SudoTransport = 'chacha20'  # cheaper per (small) message than aes-gcm
+
+    def __init__(self, sudo=False, transport=None, interactive=True):
         self.Sudo = sudo
+        if transport is None:
+            transport = RpcServerManager.SudoTransport if sudo else RpcServerManager.Transport
+        self.Transport = transport
+        self.Interactive = interactive
+        self.Timeout = None
+
+        self.Pool = None  # see RpcServerPool
+        self.Helpers = []  # managers leased on behalf of this one, see _runParallel
 
         self._Process = None
         self.RpcServer = None
@@ -34,20 +52,36 @@ class RpcServerManager:
             else:
                 return rpcServer
 
+        metrics = instrument.Active
+        if metrics is not None:
+            import time
+            t = time.perf_counter()
+
         args = []
         if self.Sudo:
             args.append('sudo')
+            if not self.Interactive:
+                args.append('-n')
         path = os.path.join(os.path.dirname(__file__), 'client.py')
         args.extend([sys.executable, path])
 
         import __main__
         import ranger
         args.extend(['-p', ranger.arg.confdir, '-p', os.path.dirname(__main__.__file__)])
+        args.extend(['-t', self.Transport])
 
-        self._Process = proc = sub.Popen(args, stdin=sub.PIPE, stdout=sub.PIPE, bufsize=-1)
-        io = rpcss.EncryptedIO(proc.stdout, proc.stdin)
+        # sudo -n fails with a message on stderr, which would garble ranger's ui
+        stderr = None if self.Interactive else sub.DEVNULL
+        self._Process = proc = sub.Popen(args, stdin=sub.PIPE, stdout=sub.PIPE, stderr=stderr, bufsize=-1)
+        io = rpcss.createIO(self.Transport, proc.stdout, proc.stdin)
         self.RpcServer = rpcServer = rpcss.RpcServer(io)
 
+        if self.Timeout is not None:
+            rpcServer.setTimeout(self.Timeout)
+
+        if metrics is not None:
+            metrics.add('external.spawn sudo' if self.Sudo else 'external.spawn', time.perf_counter() - t)
+
         return rpcServer
 
     def stop(self):
@@ -56,8 +90,11 @@ class RpcServerManager:
             return
         self.RpcServer = None
 
-        rpcServer.stop()
-        rpcServer.IO.OutStream.close()  # sends eof
+        try:
+            rpcServer.stop()
+            rpcServer.IO.OutStream.close()  # sends eof
+        except IOError:  # already terminated
+            pass
         rpcServer.IO.InStream.close()  # usually blocks until process terminates
         self._Process.wait()  # to be save
 
@@ -65,9 +102,189 @@ class RpcServerManager:
         self.stop()
 
 
+class RpcServerPool:
+    '''
+    keeps RpcServerManagers with running sub processes and leases them.
+
+    keeps at most Size idle managers and spawns up to Warm of them in advance, see warm.
+    idle managers are stopped after Timeout seconds by a timer.
+    the clients stop on their own a little later, see RpcServerManager.Timeout.
+    '''
+
+    Time = None
+    TIMEOUT_MARGIN = 5
+
+    def __init__(self, sudo=False, size=None, warm=1, timeout=60):
+        if RpcServerPool.Time is None:
+            import time
+            RpcServerPool.Time = time
+
+        self.Sudo = sudo
+        self.Size = (os.cpu_count() or 1) if size is None else size
+        self.Warm = warm
+        self.Timeout = timeout
+
+        self._Idle = []  # [(release time, RpcServerManager)]
+        self._Lock = threading.Lock()
+        self._Spawning = 0
+        self._Timer = None  # see _scheduleReap
+
+    def _createManager(self, interactive=True):
+        r = RpcServerManager(sudo=self.Sudo, interactive=interactive)
+        r.Pool = self
+        r.Timeout = self.Timeout + RpcServerPool.TIMEOUT_MARGIN
+        return r
+
+    def lease(self):
+        '''
+        returns an idle or new RpcServerManager.
+        '''
+        self._reap()
+
+        with self._Lock:
+            r = self._Idle.pop()[1] if len(self._Idle) != 0 else None
+
+        metrics = instrument.Active
+        if metrics is not None:
+            metrics.count('external.pool misses' if r is None else 'external.pool hits')
+
+        if r is None:
+            r = self._createManager()
+        r.Interactive = True
+
+        self.warm()
+        return r
+
+    def tryLease(self):
+        '''
+        returns an idle RpcServerManager or None, never spawns.
+        '''
+        self._reap()
+
+        with self._Lock:
+            if len(self._Idle) == 0:
+                return None
+            r = self._Idle.pop()[1]
+
+        metrics = instrument.Active
+        if metrics is not None:
+            metrics.count('external.pool hits')
+
+        r.Interactive = True
+        return r
+
+    def release(self, rpcServerManager):
+        '''
+        keeps rpcServerManager if alive and there is room, stops it otherwise.
+        '''
+        rpcServer = rpcServerManager.RpcServer
+        if rpcServer is not None:
+            try:
+                rpcServer.closeStreams()  # left by a destroyed loader
+                rpcServer.setPause(False)  # see SubCopyLoader.pause
+                rpcServer.pass_()  # check if still alive
+            except IOError:
+                rpcServer = None
+
+        with self._Lock:
+            keep = rpcServer is not None and len(self._Idle) < self.Size
+            if keep:
+                self._Idle.append((RpcServerPool.Time.monotonic(), rpcServerManager))
+
+        if not keep:
+            rpcServerManager.stop()
+
+        self._reap()
+        self._scheduleReap()
+
+    def _reap(self):
+        time = RpcServerPool.Time.monotonic()
+        with self._Lock:
+            expired = [manager for t, manager in self._Idle if self.Timeout <= time - t]
+            self._Idle = [(t, manager) for t, manager in self._Idle if time - t < self.Timeout]
+
+        for manager in expired:
+            manager.stop()
+
+    def _scheduleReap(self):
+        '''
+        starts a timer which reaps when the first idle manager expires, unless there is one.
+        '''
+        with self._Lock:
+            if self._Timer is not None or len(self._Idle) == 0:
+                return
+
+            delay = min(t for t, _ in self._Idle) + self.Timeout - RpcServerPool.Time.monotonic()
+            self._Timer = timer = threading.Timer(max(0, delay), self._onTimer)
+            timer.daemon = True
+        timer.start()
+
+    def _onTimer(self):
+        with self._Lock:
+            self._Timer = None
+
+        self._reap()
+        self._scheduleReap()
+
+    def warm(self, count=None):
+        '''
+        spawns sub processes in the background until max(Warm, count) managers (at most Size) are idle.
+
+        each sub process is spawned by a thread of its own.
+        sudo won't ask for a password, see RpcServerManager.
+        '''
+        count = self.Warm if count is None else max(self.Warm, count)
+        with self._Lock:
+            n = min(count, self.Size) - len(self._Idle) - self._Spawning
+            if n <= 0:
+                return
+            self._Spawning += n
+
+        for _ in range(n):
+            thread = threading.Thread(target=self._spawn)
+            thread.daemon = True
+            thread.start()
+
+    def _spawn(self):
+        manager = self._createManager(interactive=False)
+        try:
+            manager.getRpcServer()
+        except Exception:
+            manager.stop()
+            manager = None
+
+        with self._Lock:
+            self._Spawning -= 1
+            if manager is not None:
+                self._Idle.append((RpcServerPool.Time.monotonic(), manager))
+
+        self._scheduleReap()
+
+    def stop(self):
+        with self._Lock:
+            idle = self._Idle
+            self._Idle = []
+            timer = self._Timer
+            self._Timer = None
+
+        if timer is not None:
+            timer.cancel()
+
+        for _, manager in idle:
+            manager.stop()
+
+
 GlobalRpcServerManager = RpcServerManager()
 GlobalSudoRpcServerManager = RpcServerManager(sudo=True)
 
+GlobalRpcServerPool = RpcServerPool()
+GlobalSudoRpcServerPool = RpcServerPool(sudo=True)
+
+
+def getRpcServerPool(sudo):
+    return GlobalSudoRpcServerPool if sudo else GlobalRpcServerPool
+
+
 ActiveRpcServerManager = None
 
 
@@ -92,6 +309,27 @@ def call(f, externalF=None):
     return g
 
 
+def batched(f, externalF=None):
+    '''
+    decorator for external function calls which may be deferred.
+
+    like call, but if ActiveBatch is not None: adds the external call to ActiveBatch and returns None.
+    '''
+    if externalF is None:
+        externalF = f
+
+    def g(*args, **kwargs):
+        if ActiveRpcServerManager is None:
+            return f(*args, **kwargs)
+        if ActiveBatch is not None:
+            ActiveBatch.add(ActiveRpcServerManager, externalF, args, kwargs)
+            return None
+        rpcServer = ActiveRpcServerManager.getRpcServer()
+        return rpcServer.call(externalF, args, kwargs)
+
+    return g
+
+
 def iter(f, externalF=None, step=False):
     '''
     decorator for external iterator/generator call.
@@ -126,12 +364,18 @@ def _iter(rpcServerManager, externalF, args, kwargs, step):
         yield item
 
 
-def progress(f, externalF=None, delay=loader.Loader.seconds_of_work_time):
+PROGRESS_INTERVAL = 0.1  # seconds between progress updates
+PROGRESS_WINDOW = 4  # progress updates in flight, see rpcss.Stream
+
+
+def progress(f, externalF=None, delay=loader.Loader.seconds_of_work_time, interval=PROGRESS_INTERVAL):
     '''
     decorator for external non-blocking progress iterator/generator call.
 
     if ActiveRpcServerManager is None: calls f directly
     else: calls externalF (or f if externalF is None) using ActiveRpcServerManager.
+
+    the client sends the latest item every interval seconds, see rpcss.RpcServer.call_iter.
     '''
     if externalF is None:
         externalF = f
@@ -139,39 +383,43 @@ def progress(f, externalF=None, delay=loader.Loader.seconds_of_work_time):
     def g(*args, **kwargs):
         if ActiveRpcServerManager is None:
             return f(*args, **kwargs)
-        return _progress(ActiveRpcServerManager, externalF, args, kwargs, delay)
+        return _progress(ActiveRpcServerManager, externalF, args, kwargs, delay, interval)
 
     return g
 
 
-def _progress(rpcServerManager, externalF, args, kwargs, delay):
+def _progress(rpcServerManager, externalF, args, kwargs, delay, interval):
     '''
     calls RpcServerManager.getRpcServer on first next().
-    '''
-    import time
 
+    each next() waits at most delay seconds for an update.
+    '''
     rpcServer = rpcServerManager.getRpcServer()
-    x = rpcServer.call_iter(externalF, args, kwargs)
+    x = rpcServer.call_iter(externalF, args, kwargs, window=PROGRESS_WINDOW, interval=interval)
 
-    current = next(x)
-    yield current
+    try:
+        current = next(x)
+        yield current
 
-    while True:
-        time.sleep(delay)
+        while True:
+            x.wait(timeout=delay)
 
-        n = None
-        while rpcServer.hasInput():
-            try:
-                n = next(x)
-            except StopIteration:
-                if n is not None:
-                    yield n
-                return
+            n = None
+            while x.hasInput():
+                try:
+                    n = next(x)
+                except StopIteration:
+                    if n is not None:
+                        yield n
+                    return
 
-        if n is not None:
-            current = n
+            if n is not None:
+                current = n
 
-        yield current
+            yield current
+
+    finally:
+        x.close()  # on cancel
 
 
 Sudo = False
@@ -194,6 +442,38 @@ def sudo_(f):
     return g
 
 
+Resume = False
+
+
+def resume_(f):
+    '''
+    decorator that sets Resume to True during call.
+    '''
+    def g(*args, **kwargs):
+        global Resume
+        Resume = True
+        try:
+            r = f(*args, **kwargs)
+        finally:
+            Resume = False
+
+        return r
+
+    return g
+
+
+def resumable(f):
+    '''
+    decorator that passes resume=Resume to f while ActiveRpcServerManager is not None, see fastcopy.copyFile.
+    '''
+    def g(*args, **kwargs):
+        if ActiveRpcServerManager is not None:
+            kwargs['resume'] = Resume
+        return f(*args, **kwargs)
+
+    return g
+
+
 def global_(f, defaultRpcServerManager=None):
     '''
     decorator that sets ActiveRpcServerManager to defaultRpcServerManager or GlobalSudoRpcServerManager.
@@ -215,6 +495,138 @@ def global_(f, defaultRpcServerManager=None):
     return g
 
 
+ActiveBatch = None
+
+
+class Batch:
+    '''
+    external calls deferred during batch_, see batched.
+    '''
+
+    def __init__(self):
+        self.Items = {}  # RpcServerManager: [(f, args, kwargs, paths)], see fsops.runBatch
+        self.Paths = set()  # of all items, see _next_available_filename
+
+    def add(self, rpcServerManager, f, args, kwargs):
+        paths = [os.path.abspath(os.fsdecode(x)) for x in args if isinstance(x, (str, bytes, os.PathLike))]
+        self.Items.setdefault(rpcServerManager, []).append((f, args, kwargs, paths))
+        self.Paths.update(paths)
+
+    def submit(self, fm, description):
+        '''
+        adds a BatchLoader for each RpcServerManager.
+        '''
+        for rpcServerManager, items in self.Items.items():
+            fm.loader.add(BatchLoader(rpcServerManager, items, description, fm), append=True)
+
+
+class BatchLoader(loader.Loadable):
+    '''
+    runs items in a sub process as a single job, see fsops.runBatch.
+
+    notifies about errors and reloads the affected directories when done.
+    '''
+
+    progressbar_supported = True
+    MAX_NOTIFY = 5  # errors
+
+    def __init__(self, rpcServerManager, items, description, fm, delay=loader.Loader.seconds_of_work_time):
+        self.RpcServerManager = rpcServerManager
+        self.Items = items
+        self.Fm = fm
+        self.Delay = delay
+
+        self.Errors = []  # [(index, message)]
+
+        super().__init__(self.generate(), '{}: {} items'.format(description, len(items)))
+
+    def generate(self):
+        rpcServer = self.RpcServerManager.getRpcServer()
+        x = rpcServer.call_iter(fsops.runBatch, (self.Items,), window=PROGRESS_WINDOW)
+
+        try:
+            while True:
+                x.wait(timeout=self.Delay)
+
+                while x.hasInput():
+                    try:
+                        done, errors = next(x)
+                    except StopIteration:
+                        self._finish()
+                        return
+
+                    self.Errors.extend(errors)
+                    self.percent = 100 * done / len(self.Items)
+
+                yield
+
+        finally:
+            x.close()  # on cancel
+
+    def _finish(self):
+        fm = self.Fm
+        for _, message in self.Errors[:BatchLoader.MAX_NOTIFY]:
+            fm.notify(message, bad=True)
+        if BatchLoader.MAX_NOTIFY < len(self.Errors):
+            fm.notify('{} more errors'.format(len(self.Errors) - BatchLoader.MAX_NOTIFY), bad=True)
+
+        dirPaths = set(os.path.dirname(path) for _, _, _, paths in self.Items for path in paths)
+        for dirPath in dirPaths:
+            directory = fm.directories.get(dirPath)
+            if directory is not None:
+                directory.load_content()
+
+
+def batch_(f, description):
+    '''
+    decorator for methods of ranger commands and actions.
+
+    defers batched calls during f and submits them as one Batch.
+    '''
+    def g(self, *args, **kwargs):
+        global ActiveBatch
+        if ActiveBatch is not None:  # nested
+            return f(self, *args, **kwargs)
+
+        ActiveBatch = batch = Batch()
+        try:
+            r = f(self, *args, **kwargs)
+        finally:
+            ActiveBatch = None
+            batch.submit(self.fm, description)
+
+        return r
+
+    return g
+
+
+def _next_available_filename(fname, directory='.'):
+    '''
+    like ranger.ext.next_available_filename, but the paths of ActiveBatch count as existing.
+
+    otherwise paste (sym/hard) link picks the same name for entries with the same name.
+    '''
+    names = set(os.listdir(directory))
+
+    batch = ActiveBatch
+    if batch is not None:
+        directory = os.path.realpath(directory)
+        names.update(os.path.basename(path) for path in batch.Paths
+                     if os.path.realpath(os.path.dirname(path)) == directory)
+
+    if fname not in names:
+        return fname
+    if not fname.endswith('_'):
+        fname += '_'
+        if fname not in names:
+            return fname
+
+    for i in range(1, len(names) + 1):
+        if fname + str(i) not in names:
+            return fname + str(i)
+    return None
+
+
 class sudo(shared.SuperCommand):
     '''
     shared.SuperCommand that sets Sudo to True during quick, tab, execute and cancel.
@@ -229,24 +641,59 @@ class sudo(shared.SuperCommand):
     cancel = sudo_(shared.SuperCommand.cancel)
 
 
+class resume(shared.SuperCommand):
+    '''
+    shared.SuperCommand that sets Resume to True during quick, tab, execute and cancel.
+
+    e.g. `resume paste overwrite=True` skips complete files and continues partial ones.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    quick = resume_(shared.SuperCommand.quick)
+    tab = resume_(shared.SuperCommand.tab)
+    execute = resume_(shared.SuperCommand.execute)
+    cancel = resume_(shared.SuperCommand.cancel)
+
+
 def subclassCopyLoader(CopyLoader):
     class SubCopyLoader(CopyLoader):
         '''
-        sets ActiveRpcServerManager to self.RpcServerManager during each next().
+        sets ActiveRpcServerManager to self.RpcServerManager and Resume to self.Resume during each next().
+
+        self.RpcServerManager is leased from getRpcServerPool.
+
+        the entries of copy_buffer are copied or moved in parallel, see _generate.
         '''
 
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
 
-            self.RpcServerManager = RpcServerManager(sudo=Sudo)
+            self.RpcServerManager = getRpcServerPool(Sudo).lease()
+            self.Resume = Resume
+            self.Size = None
+
+        def _calculate_size(self, step):
+            '''
+            exact number of bytes to copy, see fastcopy.getSize.
+
+            the copy functions report exact numbers too, so step doesn't matter.
+            '''
+            if self.Size is None:
+                paths = [fobj.path for fobj in self.copy_buffer]
+                self.Size = self.RpcServerManager.getRpcServer().call(fastcopy.getSize, (paths,))
+            return self.Size
 
         def generate(self):
-            global ActiveRpcServerManager
+            global ActiveRpcServerManager, Resume
 
-            gen = super().generate()
+            gen = self._generate()
             while True:
                 t = ActiveRpcServerManager
                 ActiveRpcServerManager = self.RpcServerManager
+                resume = Resume
+                Resume = self.Resume
 
                 try:
                     n = next(gen)
@@ -257,26 +704,103 @@ def subclassCopyLoader(CopyLoader):
                     raise
                 finally:
                     ActiveRpcServerManager = t
+                    Resume = resume
 
                 yield n
 
             self._stop()
 
+        def _generate(self, delay=loader.Loader.seconds_of_work_time, interval=PROGRESS_INTERVAL):
+            '''
+            like ranger's generate, but spreads the entries of copy_buffer across sub processes, see _runParallel.
+
+            a single entry is left to ranger's generate, see parallelCopytree.
+            so are entries with the same name, and existing destinations unless overwrite,
+            make_safe_path might pick the same name for several entries.
+            '''
+            import ranger.ext.shutil_generatorized as m
+            from ranger.ext.human_readable import human_readable
+
+            copyBuffer = self.copy_buffer
+            names = [fobj.basename for fobj in copyBuffer]
+            dst = self.original_path
+            if self.RpcServerManager.Pool is None or len(copyBuffer) < 2 or len(set(names)) != len(names) or \
+                    (not self.overwrite and any(os.path.lexists(os.path.join(dst, name)) for name in names)):
+                yield from super().generate()
+                return
+
+            size = self._calculate_size(1)
+            sizeStr = ' (' + human_readable(size) + ')'
+
+            tasks = []
+            if self.do_cut:
+                self.original_copy_buffer.clear()
+                self.description = 'moving files from: ' + self.one_file.dirname + sizeStr
+                self._moveTags()
+
+                for fobj in copyBuffer:
+                    tasks.append((_shutil_gen_move, (fobj.path, dst, self.overwrite, self.make_safe_path), fobj.path,
+                                  dst))
+
+            else:
+                self.description = 'copying files from: ' + self.one_file.dirname + sizeStr
+
+                for fobj in copyBuffer:
+                    dstName = os.path.join(dst, fobj.basename)
+                    tasks.append((_shutil_gen_copytree_entry, (fobj.path, dstName, True, None, self.overwrite,
+                                                               self.make_safe_path, self.Resume), fobj.path, dstName))
+
+            gen = _runParallel(self.RpcServerManager, tasks, delay, interval)
+            while True:
+                try:
+                    n = next(gen)
+                except StopIteration as e:
+                    errors = e.value
+                    break
+
+                self.percent = n / max(1, size) * 100.
+                yield
+
+            cwd = self.fm.get_directory(self.original_path)
+            cwd.load_content()
+
+            if len(errors) != 0:
+                raise m.Error(errors)
+
+        def _moveTags(self):
+            '''
+            from ranger's generate.
+            '''
+            tags = self.fm.tags
+            for fobj in self.copy_buffer:
+                for path in list(tags.tags):
+                    if path == fobj.path or str(path).startswith(fobj.path):
+                        tag = tags.tags[path]
+                        tags.remove(path)
+                        tags.tags[path.replace(fobj.path, os.path.join(self.original_path, fobj.basename))] = tag
+                        tags.dump()
+
         def _stop(self):
-            self.RpcServerManager.stop()
+            rpcServerManager = self.RpcServerManager
             self.RpcServerManager = None
+            rpcServerManager.Pool.release(rpcServerManager)
+
+        def _setPause(self, value):
+            rpcServerManager = self.RpcServerManager
+            if rpcServerManager is None:
+                return
+
+            for manager in [rpcServerManager] + rpcServerManager.Helpers:
+                rpcServer = manager.getRpcServer()
+                rpcServer.setPause(value)
 
         def pause(self):
-            if self.RpcServerManager is not None:
-                rpcServer = self.RpcServerManager.getRpcServer()
-                rpcServer.setPause(True)
+            self._setPause(True)
 
             return super().pause()
 
         def unpause(self):
-            if self.RpcServerManager is not None:
-                rpcServer = self.RpcServerManager.getRpcServer()
-                rpcServer.setPause(False)
+            self._setPause(False)
 
             return super().unpause()
 
@@ -292,77 +816,190 @@ def subclassCopyLoader(CopyLoader):
 CopyLoader = subclassCopyLoader(loader.CopyLoader)
 
 
-class Counter(threading.Thread):
+def _shutil_gen_move(*args, **kwargs):
+    return fastcopy.move(*args, **kwargs)
+
+
+def _shutil_gen_copytree(*args, **kwargs):
+    return fastcopy.copytree(*args, **kwargs)
+
+
+def _shutil_gen_copy2(*args, **kwargs):
+    return fastcopy.copy2(*args, **kwargs)
+
+
+def _shutil_gen_copytree_prepare(src, dst, ignore, overwrite, make_safe_path):
     '''
-    threaded counter.
+    first part of ranger.ext.shutil_generatorized.copytree.
+
+    returns (dst, names).
     '''
+    names = os.listdir(src)
+    if ignore is not None:
+        ignoredNames = ignore(src, names)
+        names = [name for name in names if name not in ignoredNames]
 
-    Time = None
+    try:
+        os.makedirs(dst)
+    except OSError:
+        if not overwrite:
+            dst = fastcopy.getSafePath(dst, make_safe_path)
+            os.makedirs(dst)
 
-    def __init__(self, interval=1, autostart=True):
-        super().__init__()
+    return dst, names
 
-        self.Interval = interval
-        self.Autostart = autostart
 
-        self.Count = 0
-        self.Stop = False
+def _shutil_gen_copytree_entry(srcName, dstName, symlinks, ignore, overwrite, make_safe_path, resume):
+    '''
+    loop body of ranger.ext.shutil_generatorized.copytree.
+    '''
+    if os.path.isdir(srcName) and not (symlinks and os.path.islink(srcName)):
+        return fastcopy.copytree(srcName, dstName, symlinks, ignore, overwrite, make_safe_path, resume=resume)
+    return fastcopy.copy2(srcName, dstName, overwrite=overwrite, symlinks=symlinks, make_safe_path=make_safe_path,
+                          resume=resume)
 
-        if Counter.Time is None:
-            import time
-            Counter.Time = time
 
-        self.daemon = True
+def _shutil_copystat(*args, **kwargs):
+    import shutil
+    return shutil.copystat(*args, **kwargs)
 
-        if autostart:
-            self.start()
 
-    def run(self):
-        while not self.Stop:
-            Counter.Time.sleep(self.Interval)
-            self.Count += 1
+def parallelCopytree(f, delay=loader.Loader.seconds_of_work_time, interval=PROGRESS_INTERVAL):
+    '''
+    decorator for ranger.ext.shutil_generatorized.copytree.
 
+    if ActiveRpcServerManager is None: calls f directly
+    elif ActiveRpcServerManager.Pool is None: like progress
+    else: copies the entries of src in parallel using sub processes leased from ActiveRpcServerManager.Pool.
 
-def deferred(x, interval=0.33):
+    several selected files are spread by SubCopyLoader._generate.
+    passes resume=Resume like resumable.
     '''
-    yields items of x only once in a while.
+    def g(src, dst, symlinks=False, ignore=None, overwrite=False, **kwargs):
+        args = (src, dst, symlinks, ignore, overwrite)
+        if ActiveRpcServerManager is None:
+            return f(*args, **kwargs)
+
+        if ActiveRpcServerManager.Pool is None or len(kwargs.keys() - {'make_safe_path'}) != 0:
+            return _progress(ActiveRpcServerManager, _shutil_gen_copytree, args, dict(kwargs, resume=Resume), delay,
+                             interval)
+        return _parallel_copytree(ActiveRpcServerManager, args + (kwargs.get('make_safe_path'), Resume), delay,
+                                  interval)
 
-    uses Counter.
+    return g
+
+
+def _parallel_copytree(rpcServerManager, args, delay, interval):
+    '''
+    yields the number of bytes copied so far.
+
+    copies the entries of src in parallel, see _runParallel.
     '''
-    counter = Counter(interval=interval)
-    count = counter.Count
-    prev = None
+    import ranger.ext.shutil_generatorized as m
+
+    src, dst, symlinks, ignore, overwrite, make_safe_path, resume = args
+
+    rpcServer = rpcServerManager.getRpcServer()
+    dst, names = rpcServer.call(_shutil_gen_copytree_prepare, (src, dst, ignore, overwrite, make_safe_path))
+
+    tasks = []
+    for name in names:
+        srcName = os.path.join(src, name)
+        dstName = os.path.join(dst, name)
+        tasks.append((_shutil_gen_copytree_entry, (srcName, dstName, symlinks, ignore, overwrite, make_safe_path,
+                                                   resume), srcName, dstName))
+
+    errors = yield from _runParallel(rpcServerManager, tasks, delay, interval)
 
     try:
-        n = None
-        for n in x:
-            if counter.Count == count:
-                continue
-            count = counter.Count
+        rpcServer.call(_shutil_copystat, (src, dst))
+    except OSError as e:
+        errors.append((src, dst, str(e)))
 
-            yield n
-            prev = n
+    if len(errors) != 0:
+        raise m.Error(errors)
 
-        if n is not prev:
-            yield n
 
-    finally:
-        counter.Stop = True
+def _runParallel(rpcServerManager, tasks, delay, interval):
+    '''
+    generator, runs tasks [(externalF, args, src, dst)] and yields the number of bytes done so far.
 
+    externalF(*args) must yield the number of bytes done so far, like fastcopy.copytree.
+    each next() waits at most delay seconds for an update of the first job.
+    tasks run on rpcServerManager and on up to rpcServerManager.Pool.Size - 1 helpers.
+    the helpers are spawned in the background and used once ready (see RpcServerPool.warm and tryLease),
+    see RpcServerManager.Helpers.
 
-def _shutil_gen_move(*args, **kwargs):
+    returns the errors, see ranger.ext.shutil_generatorized.Error.
+    '''
+    import collections
     import ranger.ext.shutil_generatorized as m
-    return deferred(m.move(*args, **kwargs))
 
+    pool = rpcServerManager.Pool
+    tasks = collections.deque(tasks)
 
-def _shutil_gen_copytree(*args, **kwargs):
-    import ranger.ext.shutil_generatorized as m
-    return deferred(m.copytree(*args, **kwargs))
+    managers = [rpcServerManager]
+    helpers = rpcServerManager.Helpers
+    jobs = {}  # manager: [stream, bytes, task]
+    done = 0
+    errors = []
 
+    try:
+        pool.warm(count=min(pool.Size, len(tasks)) - 1)
 
-def _shutil_gen_copy2(*args, **kwargs):
-    import ranger.ext.shutil_generatorized as m
-    return deferred(m.copy2(*args, **kwargs))
+        while len(tasks) != 0 or len(jobs) != 0:
+            # more tasks than idle managers
+            while len(managers) - len(jobs) < len(tasks) and len(managers) < pool.Size:
+                manager = pool.tryLease()
+                if manager is None:
+                    break
+                helpers.append(manager)
+                managers.append(manager)
+
+            for manager in managers:
+                if manager in jobs or len(tasks) == 0:
+                    continue
+
+                task = tasks.popleft()
+                stream = manager.getRpcServer().call_iter(task[0], task[1], window=PROGRESS_WINDOW,
+                                                          interval=interval)
+                jobs[manager] = [stream, 0, task]
+
+            if len(jobs) != 0:
+                list(jobs.values())[0][0].wait(timeout=delay)
+
+            for manager, job in list(jobs.items()):
+                stream = job[0]
+                while stream.hasInput():
+                    try:
+                        job[1] = next(stream)
+                    except StopIteration:
+                        pass
+                    except m.Error as e:
+                        if isinstance(e.args[0], list):
+                            errors.extend(e.args[0])
+                        else:  # e.g. same file
+                            errors.append((job[2][2], job[2][3], str(e)))
+                    except EnvironmentError as e:
+                        errors.append((job[2][2], job[2][3], str(e)))
+                    else:
+                        continue
+
+                    done += job[1]
+                    del jobs[manager]
+                    break
+
+            yield done + sum(job[1] for job in jobs.values())
+
+    finally:
+        for stream, _, _ in jobs.values():
+            stream.close()
+
+        for manager in managers[1::]:
+            helpers.remove(manager)
+            pool.release(manager)
+
+    return errors
 
 
 Backups = {}  # module: name: f
@@ -389,10 +1026,10 @@ def enableCopy():
     shutil_gen.move = progress(f, _shutil_gen_move)
 
     f = m.setdefault('copytree', shutil_gen.copytree)
-    shutil_gen.copytree = progress(f, _shutil_gen_copytree)
+    shutil_gen.copytree = parallelCopytree(f)
 
     f = m.setdefault('copy2', shutil_gen.copy2)
-    shutil_gen.copy2 = progress(f, _shutil_gen_copy2)
+    shutil_gen.copy2 = resumable(progress(f, _shutil_gen_copy2))
 
     Backups.setdefault('loader', {}).setdefault('CopyLoader', loader.CopyLoader)
     loader.CopyLoader = CopyLoader
@@ -416,6 +1053,8 @@ def disableCopy():
 class delete(commands.delete):
     '''
     stores Sudo on execute and sets Sudo during _question_callback.
+
+    external calls are batched, see batch_.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -428,6 +1067,8 @@ class delete(commands.delete):
 
         return super().execute(*args, **kwargs)
 
+    execute = batch_(execute, 'delete')
+
     def _question_callback(self, *args, **kwargs):
         global Sudo
         Sudo = self.Sudo
@@ -439,6 +1080,8 @@ class delete(commands.delete):
 
         return r
 
+    _question_callback = batch_(_question_callback, 'delete')
+
 
 def _os_remove(*args, **kwargs):
     import os
@@ -446,8 +1089,7 @@ def _os_remove(*args, **kwargs):
 
 
 def _shutil_rmtree(*args, **kwargs):
-    import shutil
-    return shutil.rmtree(*args, **kwargs)
+    return fsops.rmtree(*args, **kwargs)
 
 
 def enableDelete():
@@ -462,10 +1104,10 @@ def enableDelete():
     import shutil
 
     f = Backups.setdefault('os', {}).setdefault('remove', os.remove)
-    os.remove = global_(call(f, _os_remove))
+    os.remove = global_(batched(f, _os_remove))
 
     f = Backups.setdefault('shutil', {}).setdefault('rmtree', shutil.rmtree)
-    shutil.rmtree = global_(call(f, _shutil_rmtree))
+    shutil.rmtree = global_(batched(f, _shutil_rmtree))
 
 
 def disableDelete():
@@ -496,10 +1138,10 @@ def enableMkdir():
     import os
 
     f = Backups.setdefault('os', {}).setdefault('mkdir', os.mkdir)
-    os.mkdir = global_(call(f, _os_mkdir))
+    os.mkdir = global_(batched(f, _os_mkdir))
 
     f = Backups.setdefault('os', {}).setdefault('makedirs', os.makedirs)
-    os.makedirs = global_(call(f, _os_makedirs))
+    os.makedirs = global_(batched(f, _os_makedirs))
 
 
 def disableMkdir():
@@ -525,7 +1167,7 @@ def enableRename():
     import os
 
     f = Backups.setdefault('os', {}).setdefault('rename', os.rename)
-    os.rename = global_(call(f, _os_rename))
+    os.rename = global_(batched(f, _os_rename))
 
 
 def disableRename():
@@ -557,20 +1199,28 @@ def enableSymlink():
         ranger.ext.relative_symlink
     .symlink,
         ranger.core.actions
-    .symlink
+    .symlink,
+    .Actions.paste_symlink,
+    .next_available_filename
     '''
     import os
     import ranger.ext.relative_symlink as relative_sym
     import ranger.core.actions as actions
 
     f = Backups.setdefault('os', {}).setdefault('symlink', os.symlink)
-    os.symlink = global_(call(f, _os_symlink))
+    os.symlink = global_(batched(f, _os_symlink))
 
     f = Backups.setdefault('relative_sym', {}).setdefault('relative_symlink', relative_sym.symlink)
-    relative_sym.symlink = global_(call(f, _relative_symlink))
+    relative_sym.symlink = global_(batched(f, _relative_symlink))
 
     f = Backups.setdefault('actions', {}).setdefault('symlink', actions.symlink)
-    actions.symlink = global_(call(f, _actions_symlink))
+    actions.symlink = global_(batched(f, _actions_symlink))
+
+    f = Backups['actions'].setdefault('paste_symlink', actions.Actions.paste_symlink)
+    actions.Actions.paste_symlink = batch_(f, 'paste symlink')
+
+    Backups['actions'].setdefault('next_available_filename', actions.next_available_filename)
+    actions.next_available_filename = _next_available_filename
 
 
 def disableSymlink():
@@ -579,8 +1229,22 @@ def disableSymlink():
     import ranger.core.actions as actions
 
     os.symlink = Backups['os'].pop('symlink')
-    relative_sym.symlink = Backups['relative_sym'].pop('symlink')
+    relative_sym.symlink = Backups['relative_sym'].pop('relative_symlink')
     actions.symlink = Backups['actions'].pop('symlink')
+    actions.Actions.paste_symlink = Backups['actions'].pop('paste_symlink')
+    _disableNextAvailableFilename()
+
+
+def _disableNextAvailableFilename():
+    '''
+    restores ranger.core.actions.next_available_filename unless paste symlink or hardlink is still enabled.
+    '''
+    import ranger.core.actions as actions
+
+    m = Backups['actions']
+    if 'paste_symlink' in m or 'paste_hardlink' in m or 'next_available_filename' not in m:
+        return
+    actions.next_available_filename = m.pop('next_available_filename')
 
 
 def _os_link(*args, **kwargs):
@@ -599,16 +1263,28 @@ def enableHardlink():
         os
     .link,
         ranger.core.actions
-    .link
+    .link,
+    .Actions.paste_hardlink,
+    .Actions.paste_hardlinked_subtree,
+    .next_available_filename
     '''
     import os
     import ranger.core.actions as actions
 
     f = Backups.setdefault('os', {}).setdefault('link', os.link)
-    os.link = global_(call(f, _os_link))
+    os.link = global_(batched(f, _os_link))
 
     f = Backups.setdefault('actions', {}).setdefault('link', actions.link)
-    actions.link = global_(call(f, _actions_link))
+    actions.link = global_(batched(f, _actions_link))
+
+    f = Backups['actions'].setdefault('paste_hardlink', actions.Actions.paste_hardlink)
+    actions.Actions.paste_hardlink = batch_(f, 'paste hardlink')
+
+    f = Backups['actions'].setdefault('paste_hardlinked_subtree', actions.Actions.paste_hardlinked_subtree)
+    actions.Actions.paste_hardlinked_subtree = batch_(f, 'paste hardlinked subtree')
+
+    Backups['actions'].setdefault('next_available_filename', actions.next_available_filename)
+    actions.next_available_filename = _next_available_filename
 
 
 def disableHardlink():
@@ -617,3 +1293,20 @@ def disableHardlink():
 
     os.link = Backups['os'].pop('link')
     actions.link = Backups['actions'].pop('link')
+    actions.Actions.paste_hardlink = Backups['actions'].pop('paste_hardlink')
+    actions.Actions.paste_hardlinked_subtree = Backups['actions'].pop('paste_hardlinked_subtree')
+    _disableNextAvailableFilename()
+
+
+def enableMetrics():
+    '''
+    enables shared.instrument and records the metrics of rpcss and RpcServerManager.
+
+    see the command shared.metrics.
+    '''
+    rpcss.Metrics = instrument.enable()
+
+
+def disableMetrics():
+    rpcss.Metrics = None
+    instrument.disable()
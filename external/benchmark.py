@@ -0,0 +1,421 @@
+'''
+benchmarks rpcss and the file ops of the sub processes.
+
+    python benchmark.py [-t transport ...] [options] [suite ...]
+
+suites (default: all)
+- transport: for each transport a child process is spawned and
+    - the handshake (creation of both IO objects) is timed, best of 3
+    - -m megabytes are sent to the child in frames of -f kilobytes
+- small: per transport, call and iter on a loopback pair, i.e. the cost of small messages
+- call: latency of -n calls of a function that does nothing
+- iter: throughput of a call_iter of 10 * -n items
+- copy: fastcopy.copytree of a synthetic directory (--files files of --size kilobytes)
+- delete: fsops.runBatch removing each file of the copy, fsops.rmtree of another copy
+- sw: smith_waterman.index.PathIndex.update of the synthetic directory, then a Ranking of all paths
+    and a recursive sw_nav query (-q) on them (requires parasail, ranger is stubbed if missing)
+
+all but transport, small and sw run on a loopback pair: an RpcClient in a thread of this process connected by pipes,
+for each transport given (default: plain).
+-o writes the results, --metrics the metrics recorded meanwhile (see shared/instrument.py), as json.
+'''
+
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import rpcss
+import fastcopy
+import fsops
+
+
+def _child(transport):
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    stdout.write(b'r')  # ready, see benchmarkTransport
+    stdout.flush()
+
+    io = rpcss.createIO(transport, stdin, stdout)
+
+    n = 0
+    while True:
+        x = io.read()
+        if len(x) == 0:
+            break
+        n += len(x)
+
+    io.write(str(n).encode())
+    try:
+        io.read()  # wait for eof
+    except rpcss.EOS:
+        pass
+
+
+def benchmarkTransport(transport, byteCount=2 ** 28, frameSize=2 ** 16):
+    '''
+    returns (handshake seconds, bytes per second).
+    '''
+    import subprocess as sub
+
+    proc = sub.Popen([sys.executable, os.path.abspath(__file__), '-child', transport],
+                     stdin=sub.PIPE, stdout=sub.PIPE)
+    try:
+        os.read(proc.stdout.fileno(), 1)  # exclude interpreter startup, unbuffered, see rpcss.IO
+
+        start = time.perf_counter()
+        io = rpcss.createIO(transport, proc.stdout, proc.stdin)
+        handshake = time.perf_counter() - start
+
+        x = os.urandom(frameSize)
+        frameCount = byteCount // frameSize
+
+        start = time.perf_counter()
+        for _ in range(frameCount):
+            io.write(x, flush=False)
+        io.write(b'')
+        n = int(io.read())
+        duration = time.perf_counter() - start
+
+        assert n == frameCount * frameSize
+
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    return handshake, n / duration
+
+
+class Loopback:
+    '''
+    RpcServer connected to an RpcClient running in a thread of this process.
+
+    both sides share the GIL, so results are lower bounds.
+    '''
+
+    def __init__(self, transport='plain'):
+        import threading
+
+        serverIn, clientOut = os.pipe()
+        clientIn, serverOut = os.pipe()
+        self._Streams = streams = [os.fdopen(serverIn, 'rb'), os.fdopen(serverOut, 'wb'),
+                                   os.fdopen(clientIn, 'rb'), os.fdopen(clientOut, 'wb')]
+
+        self._Thread = threading.Thread(target=self._run, args=(transport, streams[2], streams[3]))
+        self._Thread.daemon = True
+        self._Thread.start()
+
+        self.RpcServer = rpcss.RpcServer(rpcss.createIO(transport, streams[0], streams[1]))
+
+    def _run(self, transport, inStream, outStream):
+        client = rpcss.RpcClient(rpcss.createIO(transport, inStream, outStream))
+        client.main()
+
+    def stop(self):
+        self.RpcServer.stop()
+        self._Thread.join()
+
+        for stream in self._Streams:
+            stream.close()
+
+
+def _pass():
+    pass
+
+
+def _range(n):
+    for i in range(n):
+        yield i
+
+
+def _getPercentile(sortedValues, q):
+    return sortedValues[min(len(sortedValues) - 1, int(q / 100 * len(sortedValues)))]
+
+
+def benchmarkCall(rpcServer, n=10000):
+    '''
+    returns {'calls/s', 'p50 ms', 'p99 ms'}.
+    '''
+    perf_counter = time.perf_counter
+    durations = []
+    start = perf_counter()
+    for _ in range(n):
+        t = perf_counter()
+        rpcServer.call(_pass)
+        durations.append(perf_counter() - t)
+    duration = perf_counter() - start
+
+    durations.sort()
+    return {'calls/s': n / duration, 'p50 ms': 1000 * _getPercentile(durations, 50),
+            'p99 ms': 1000 * _getPercentile(durations, 99)}
+
+
+def benchmarkIter(rpcServer, n=100000):
+    '''
+    returns {'items/s'}.
+    '''
+    start = time.perf_counter()
+    count = sum(1 for _ in rpcServer.call_iter(_range, (n,)))
+    duration = time.perf_counter() - start
+
+    assert count == n
+    return {'items/s': n / duration}
+
+
+def benchmarkSmall(transport, n=10000):
+    '''
+    returns {'calls/s', 'p50 ms', 'p99 ms', 'items/s'} on a loopback pair.
+    '''
+    loopback = Loopback(transport)
+    try:
+        r = benchmarkCall(loopback.RpcServer, n=n)
+        r.update(benchmarkIter(loopback.RpcServer, n=10 * n))
+    finally:
+        loopback.stop()
+    return r
+
+
+def createTree(root, fileCount, fileSize, fanout=32):
+    '''
+    creates fileCount files of fileSize bytes below root, fanout files per directory.
+
+    directories contain up to fanout sub directories as well.
+    '''
+    data = os.urandom(fileSize)
+    for i in range(fileCount):
+        names = []
+        j = i // fanout
+        while j != 0:
+            names.append('d{}'.format(j % fanout))
+            j //= fanout
+
+        dirPath = os.path.join(root, *names)
+        os.makedirs(dirPath, exist_ok=True)
+        with open(os.path.join(dirPath, 'f{}'.format(i)), 'wb') as f:
+            f.write(data)
+
+
+def _getFiles(root):
+    return [os.path.join(dirPath, name) for dirPath, _, names in os.walk(root) for name in names]
+
+
+def benchmarkCopy(rpcServer, src, dst):
+    '''
+    returns {'MB/s', 'files/s'}.
+    '''
+    fileCount = len(_getFiles(src))
+    size = fastcopy.getSize([src])
+
+    start = time.perf_counter()
+    for _ in rpcServer.call_iter(fastcopy.copytree, (src, dst), dict(symlinks=True)):
+        pass
+    duration = time.perf_counter() - start
+
+    return {'MB/s': size / duration / 2 ** 20, 'files/s': fileCount / duration}
+
+
+def benchmarkDelete(rpcServer, src, dst):
+    '''
+    copies src to dst twice.
+
+    returns {'batch files/s', 'rmtree files/s'}.
+    '''
+    r = {}
+    for name in ('batch', 'rmtree'):
+        for _ in rpcServer.call_iter(fastcopy.copytree, (src, dst), dict(symlinks=True)):
+            pass
+        paths = _getFiles(dst)
+
+        start = time.perf_counter()
+        if name == 'batch':
+            items = [(os.remove, (path,), {}, [path]) for path in paths]
+            for _, errors in rpcServer.call_iter(fsops.runBatch, (items,)):
+                assert len(errors) == 0
+        else:
+            rpcServer.call(fsops.rmtree, (dst,))
+        duration = time.perf_counter() - start
+
+        r[name + ' files/s'] = len(paths) / duration
+        fsops.rmtree(dst, ignore_errors=True)
+
+    return r
+
+
+def _importSmithWaterman():
+    '''
+    returns the module smith_waterman.
+
+    stubs the parts of ranger it needs, unless ranger is installed.
+    '''
+    import importlib
+    import types
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+    try:
+        for name in ['ranger.api.commands', 'ranger.core.loader']:
+            importlib.import_module(name)
+    except ImportError:
+        modules = {name: types.ModuleType(name)
+                   for name in ['ranger', 'ranger.api', 'ranger.api.commands', 'ranger.core', 'ranger.core.loader']}
+        modules['ranger.api.commands'].Command = type('Command', (), {})
+        modules['ranger.core.loader'].Loadable = type('Loadable', (), {})
+        modules['ranger.core.loader'].Loader = type('Loader', (), {'seconds_of_work_time': 0.03})
+        sys.modules.update(modules)
+
+    import smith_waterman
+    return smith_waterman
+
+
+def benchmarkSw(sw, root, query, k=100):
+    '''
+    returns {'index s', 'items/s', 'candidates', 'query ms'}.
+
+    items/s: scoring of every path, query ms: filter and scoring like sw_nav in recursive mode.
+    '''
+    pathIndex = sw.index.PathIndex(root, directory=os.path.join(os.path.dirname(root), 'sw_index'))
+
+    start = time.perf_counter()
+    for _ in pathIndex.update():
+        pass
+    indexDuration = time.perf_counter() - start
+
+    sortKey = sw.SwSplitApplySortKey()
+    sortKey.setRef(query)
+    paths = [pathIndex.getPath(i) for i in range(len(pathIndex))]
+
+    def rank(items, prefilterF=None):
+        ranking = sw.Ranking(items, sortKey, k=k, prefilterF=prefilterF)
+        start = time.perf_counter()
+        ranking.start()
+        ranking.wait()
+        ranking.result()
+        return ranking, time.perf_counter() - start
+
+    _, duration = rank(paths)
+
+    refs = query.split()
+    ranking, queryDuration = rank(pathIndex, prefilterF=lambda pathIndex: pathIndex.filter(refs))
+
+    return {'index s': indexDuration, 'items/s': len(paths) / duration, 'candidates': len(ranking.Items),
+            'query ms': 1000 * queryDuration}
+
+
+SUITES = ('transport', 'small', 'call', 'iter', 'copy', 'delete', 'sw')
+
+
+def main(args):
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='benchmarks rpcss and the file ops of the sub processes')
+    parser.add_argument('suites', nargs='*', default=SUITES, help=', '.join(SUITES))
+    parser.add_argument('-t', action='append', dest='transports', help='transport (repeatable)')
+    parser.add_argument('-m', type=int, default=256, help='megabytes to send (transport)')
+    parser.add_argument('-f', type=int, default=64, help='frame size in kilobytes (transport)')
+    parser.add_argument('-n', type=int, default=10000,
+                        help='number of calls (call, small), 10 times the items (iter, small)')
+    parser.add_argument('--files', type=int, default=5000, help='number of files (copy, delete, sw)')
+    parser.add_argument('--size', type=int, default=16, help='file size in kilobytes (copy, delete, sw)')
+    parser.add_argument('-q', default='d1 f10', help='query (sw)')
+    parser.add_argument('--dir', default=None, help='directory for the synthetic files (default: temporary)')
+    parser.add_argument('-o', default=None, help='json file to write the results to')
+    parser.add_argument('--metrics', default=None, help='json file to write the metrics to')
+    args = parser.parse_args(args)
+
+    unknown = set(args.suites) - set(SUITES)
+    if len(unknown) != 0:
+        parser.error('unknown suites: {}'.format(', '.join(sorted(unknown))))
+
+    metrics = None
+    if args.metrics is not None:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared'))
+        import instrument
+        rpcss.Metrics = metrics = instrument.enable()
+
+    results = {}  # suite: transport: {name: value}
+
+    def report(suite, transport, r):
+        results.setdefault(suite, {})[transport] = r
+        print('{:<10} {:<10} {}'.format(suite, transport,
+                                        '  '.join('{} {:.3f}'.format(name, value) for name, value in r.items())))
+
+    if 'transport' in args.suites:
+        for transport in (args.transports or sorted(rpcss.TRANSPORTS)):
+            try:
+                handshake, speed = benchmarkTransport(transport, byteCount=args.m * 2 ** 20,
+                                                      frameSize=args.f * 2 ** 10)
+            except ImportError as e:
+                print('{:<10} {:<10} {}'.format('transport', transport, e))
+                continue
+
+            # first handshake includes imports
+            for _ in range(2):
+                handshake = min(handshake, benchmarkTransport(transport, byteCount=0)[0])
+
+            report('transport', transport, {'handshake ms': 1000 * handshake, 'MB/s': speed / 2 ** 20})
+
+    if 'small' in args.suites:
+        for transport in (args.transports or sorted(rpcss.TRANSPORTS)):
+            try:
+                r = benchmarkSmall(transport, n=args.n)
+            except ImportError as e:
+                print('{:<10} {:<10} {}'.format('small', transport, e))
+                continue
+            report('small', transport, r)
+
+    loopbackSuites = [suite for suite in args.suites if suite not in ('transport', 'small', 'sw')]
+    if len(loopbackSuites) != 0 or 'sw' in args.suites:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            src = os.path.join(directory, 'src')
+            dst = os.path.join(directory, 'dst')
+            if 'copy' in loopbackSuites or 'delete' in loopbackSuites or 'sw' in args.suites:
+                createTree(src, args.files, args.size * 2 ** 10)
+
+            if 'sw' in args.suites:
+                try:
+                    sw = _importSmithWaterman()
+                except ImportError as e:
+                    print('{:<10} {:<10} {}'.format('sw', '-', e))
+                else:
+                    report('sw', '-', benchmarkSw(sw, src, args.q))
+
+            transports = (args.transports or ['plain']) if len(loopbackSuites) != 0 else []
+            for transport in transports:
+                loopback = Loopback(transport)
+                try:
+                    rpcServer = loopback.RpcServer
+                    for suite in loopbackSuites:
+                        if suite == 'call':
+                            r = benchmarkCall(rpcServer, n=args.n)
+                        elif suite == 'iter':
+                            r = benchmarkIter(rpcServer, n=10 * args.n)
+                        elif suite == 'copy':
+                            r = benchmarkCopy(rpcServer, src, dst)
+                            fsops.rmtree(dst)
+                        else:
+                            r = benchmarkDelete(rpcServer, src, dst)
+                        report(suite, transport, r)
+
+                finally:
+                    loopback.stop()
+
+    if args.o is not None:
+        import json
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if metrics is not None:
+        metrics.dump(path=args.metrics)
+
+
+if __name__ == '__main__':
+    if '-child' in sys.argv:
+        _child(sys.argv[sys.argv.index('-child') + 1])
+    else:
+        main(sys.argv[1:])
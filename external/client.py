@@ -26,9 +26,16 @@ if __name__ == '__main__':
 
             i += 1
 
+        # find ['-t', '{transport}']
+        transport = 'rsa'
+        if '-t' in args:
+            i = args.index('-t') + 1
+            if i < len(args):
+                transport = args[i]
+
         # start client
         import external.rpcss as rpcss
-        io = rpcss.EncryptedIO(sys.stdin.buffer, sys.stdout.buffer)
+        io = rpcss.createIO(transport, sys.stdin.buffer, sys.stdout.buffer)
 
         null = open(os.devnull, 'w')
         sys.stdout = null
@@ -37,10 +44,14 @@ if __name__ == '__main__':
         client = rpcss.RpcClient(io)
         client.main()
 
-    except Exception as e:
+    except Exception:
         import traceback
         with open('client.py.error', 'w') as f:
             f.write(traceback.format_exc())
 
     else:
-        io.InReader.join()  # wait for eof
+        try:
+            while True:
+                io.read()  # wait for eof
+        except rpcss.EOS:
+            pass
@@ -0,0 +1,527 @@
+'''
+copy engine for the sub processes, see external.enableCopy.
+
+- file data is copied by the kernel (os.copy_file_range, os.sendfile) if possible,
+  or through a large page aligned buffer
+- copytree copies files in a thread pool, so small files are copied concurrently
+- metadata is applied using file descriptors, to directories after their content
+- progress items are the exact number of bytes copied so far
+- with resume, complete files (same size and mtime) are skipped and partial ones are continued
+
+functions mirror ranger.ext.shutil_generatorized and raise shutil.Error like it does.
+'''
+
+import os
+import stat
+import errno
+import shutil
+import threading
+
+CHUNK_SIZE = 2 ** 23  # 8MB, bytes per system call and progress item
+BUFFER_SIZE = 2 ** 20  # 1MB
+RESUME_CHECK_SIZE = 2 ** 16  # bytes compared before continuing a partial file
+THREADS = 4  # per copytree
+LEASE = 0.5  # seconds workers keep copying without next, see _Copier
+YIELD_INTERVAL = 0.05  # seconds between progress items of copytree
+
+# errors of the kernel copy functions which suggest another one
+_FALLBACK_ERRNOS = frozenset([
+    errno.ENOSYS, errno.EINVAL, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ETXTBSY, errno.ENOTSOCK,
+    errno.EBADF,
+])
+
+_Unsupported = set()  # copy functions the platform lacks
+
+
+def _copyFileRange(fdSrc, fdDst, offset, end):
+    while offset < end:
+        n = os.copy_file_range(fdSrc, fdDst, min(CHUNK_SIZE, end - offset), offset, offset)
+        if n == 0:  # src shrunk, or not supported by the file system, see _copyRange
+            return
+        offset += n
+        yield offset
+
+
+def _sendfile(fdSrc, fdDst, offset, end):
+    os.lseek(fdDst, offset, os.SEEK_SET)
+    while offset < end:
+        n = os.sendfile(fdDst, fdSrc, offset, min(CHUNK_SIZE, end - offset))
+        if n == 0:
+            return
+        offset += n
+        yield offset
+
+
+_Local = threading.local()
+
+
+def _getBuffer():
+    '''
+    returns a page aligned buffer of BUFFER_SIZE bytes, one per thread.
+    '''
+    r = getattr(_Local, 'Buffer', None)
+    if r is None:
+        import mmap
+        r = _Local.Buffer = mmap.mmap(-1, BUFFER_SIZE)
+    return r
+
+
+def _copyBuffered(fdSrc, fdDst, offset, end):
+    with memoryview(_getBuffer()) as view:
+        i = 0
+        while offset < end:
+            size = min(BUFFER_SIZE, end - offset)
+            if hasattr(os, 'preadv'):
+                n = os.preadv(fdSrc, [view[:size]], offset)
+            else:
+                x = os.pread(fdSrc, size, offset)
+                n = len(x)
+                view[:n] = x
+            if n == 0:
+                return
+
+            j = 0
+            while j < n:
+                j += os.pwrite(fdDst, view[j:n], offset + j)
+            offset += n
+
+            i += n
+            if CHUNK_SIZE <= i:
+                i = 0
+                yield offset
+
+        yield offset
+
+
+_COPY_FUNCTIONS = [_copyFileRange, _sendfile, _copyBuffered]
+if not hasattr(os, 'copy_file_range'):
+    _Unsupported.add(_copyFileRange)
+if not hasattr(os, 'sendfile'):
+    _Unsupported.add(_sendfile)
+
+
+def _copyRange(fdSrc, fdDst, offset, end):
+    '''
+    generator, copies bytes offset to end and yields the offset reached.
+
+    falls back to the next copy function where the previous one stopped,
+    also if it stopped early (some file systems return 0 instead of an error).
+    stops before end if src shrunk, see copyFile.
+    '''
+    for copyF in _COPY_FUNCTIONS:
+        if copyF in _Unsupported:
+            continue
+
+        try:
+            for offset in copyF(fdSrc, fdDst, offset, end):
+                yield offset
+
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS or copyF is _copyBuffered:
+                raise
+            if e.errno == errno.ENOSYS:
+                _Unsupported.add(copyF)
+            continue
+
+        if end <= offset:
+            return
+
+
+def _copyXattrs(src, dst, followSymlinks=True):
+    if not hasattr(os, 'listxattr'):
+        return
+
+    try:
+        names = os.listxattr(src, follow_symlinks=followSymlinks)
+    except OSError:
+        return
+
+    for name in names:
+        try:
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=followSymlinks),
+                        follow_symlinks=followSymlinks)
+        except OSError:
+            pass
+
+
+def _copyMetadata(src, dst, st, followSymlinks=True):
+    '''
+    src and dst are paths or file descriptors.
+
+    like ranger.ext.shutil_generatorized.copystat, ignores errors.
+    '''
+    _copyXattrs(src, dst, followSymlinks=followSymlinks)
+
+    if followSymlinks or os.chmod in os.supports_follow_symlinks:
+        try:
+            os.chmod(dst, stat.S_IMODE(st.st_mode), follow_symlinks=followSymlinks)
+        except (OSError, NotImplementedError):
+            pass
+
+    try:
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=followSymlinks)
+    except (OSError, NotImplementedError):
+        pass
+
+
+def _getResumeOffset(fdSrc, dst, st):
+    '''
+    returns the number of bytes dst has in common with src, or None if dst is complete.
+    '''
+    try:
+        dstSt = os.stat(dst)
+    except FileNotFoundError:
+        return 0
+
+    if not stat.S_ISREG(dstSt.st_mode):
+        return 0
+    if dstSt.st_size == st.st_size and dstSt.st_mtime_ns == st.st_mtime_ns:
+        return None
+    if st.st_size < dstSt.st_size:
+        return 0
+
+    # compare the tail, a partial copy has the same one
+    size = dstSt.st_size
+    n = min(size, RESUME_CHECK_SIZE)
+    with open(dst, 'rb') as f:
+        f.seek(size - n)
+        if f.read(n) != os.pread(fdSrc, n, size - n):
+            return 0
+    return size
+
+
+def _checkRegular(path, st):
+    '''
+    raises shutil.SpecialFileError unless st is the stat of a regular file.
+
+    opening a named pipe blocks until there is a writer.
+    '''
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        return
+
+    if stat.S_ISFIFO(mode):
+        kind = 'a named pipe'
+    elif stat.S_ISSOCK(mode):
+        kind = 'a socket'
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        kind = 'a device'
+    else:
+        kind = 'not a regular file'
+    raise shutil.SpecialFileError('`{}` is {}'.format(path, kind))
+
+
+def copyFile(src, dst, resume=False):
+    '''
+    generator, copies data and metadata of regular file src to dst.
+
+    yields the number of bytes copied so far.
+    if resume, skips dst if complete (same size and mtime) and continues it if partial.
+    raises shutil.Error if src shrunk meanwhile.
+    '''
+    _checkRegular(src, os.stat(src))
+
+    # O_NONBLOCK: src may be replaced by a named pipe in the meantime
+    fdSrc = os.open(src, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0) | getattr(os, 'O_NONBLOCK', 0))
+    try:
+        st = os.fstat(fdSrc)
+        _checkRegular(src, st)
+
+        try:
+            dstSt = os.stat(dst)
+        except OSError:
+            pass
+        else:
+            if (dstSt.st_dev, dstSt.st_ino) == (st.st_dev, st.st_ino):
+                raise shutil.Error('`{}` and `{}` are the same file'.format(src, dst))
+
+        offset = _getResumeOffset(fdSrc, dst, st) if resume else 0
+        if offset is None:
+            yield st.st_size
+            return
+
+        fdDst = os.open(dst, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0), 0o666)
+        try:
+            os.ftruncate(fdDst, offset)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fdSrc, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            if offset != 0:
+                yield offset
+
+            for offset in _copyRange(fdSrc, fdDst, offset, st.st_size):
+                yield offset
+
+            if offset < st.st_size:
+                raise shutil.Error('`{}` shrunk while copying to `{}`'.format(src, dst))
+
+            _copyMetadata(fdSrc, fdDst, st)
+
+        finally:
+            os.close(fdDst)
+
+    finally:
+        os.close(fdSrc)
+
+
+def _copySymlink(src, dst, overwrite):
+    linkTo = os.readlink(src)
+    if overwrite and os.path.lexists(dst):
+        os.unlink(dst)
+    os.symlink(linkTo, dst)
+    _copyMetadata(src, dst, os.lstat(src), followSymlinks=False)
+
+
+def getSafePath(dst, make_safe_path=None):
+    if make_safe_path is None:
+        import ranger.ext.shutil_generatorized as m
+        make_safe_path = m.get_safe_path
+    return make_safe_path(dst)
+
+
+def copy2(src, dst, overwrite=False, symlinks=False, make_safe_path=None, resume=False):
+    '''
+    generator, like ranger.ext.shutil_generatorized.copy2.
+
+    resume: see copyFile, applies with overwrite only.
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if not overwrite:
+        dst = getSafePath(dst, make_safe_path)
+
+    if symlinks and os.path.islink(src):
+        _copySymlink(src, dst, overwrite)
+        return
+
+    for n in copyFile(src, dst, resume=resume and overwrite):
+        yield n
+
+
+class _Copier:
+    '''
+    copies files in worker threads.
+
+    workers stop after LEASE seconds unless extended, so they pause along with the generator using them.
+    '''
+
+    Futures = None
+    Time = None
+
+    def __init__(self, resume, threads=None):
+        if _Copier.Futures is None:
+            import concurrent.futures as futures
+            _Copier.Futures = futures
+            import time
+            _Copier.Time = time
+
+        self.Resume = resume
+
+        self.Done = 0  # bytes
+        self.Errors = []
+        self.Pending = 0  # files
+
+        self._Condition = threading.Condition()
+        self._Deadline = 0
+        self._Cancelled = False
+        if threads is None:
+            threads = THREADS
+        self._Executor = _Copier.Futures.ThreadPoolExecutor(max_workers=threads)
+        self.MaxPending = 4 * threads
+
+    def extend(self):
+        with self._Condition:
+            self._Deadline = _Copier.Time.monotonic() + LEASE
+            self._Condition.notify_all()
+
+    def submit(self, src, dst):
+        with self._Condition:
+            self.Pending += 1
+        self._Executor.submit(self._copy, src, dst)
+
+    def wait(self, timeout):
+        '''
+        waits until a file is done or timeout seconds passed.
+        '''
+        with self._Condition:
+            pending = self.Pending
+            if pending != 0:
+                self._Condition.wait_for(lambda: self.Pending != pending, timeout)
+
+    def _waitForLease(self):
+        '''
+        returns False if cancelled.
+        '''
+        condition = self._Condition
+        with condition:
+            while not self._Cancelled and self._Deadline <= _Copier.Time.monotonic():
+                condition.wait()
+            return not self._Cancelled
+
+    def _copy(self, src, dst):
+        prev = 0
+        try:
+            if not self._waitForLease():
+                return
+
+            for n in copyFile(src, dst, resume=self.Resume):
+                with self._Condition:
+                    self.Done += n - prev
+                prev = n
+
+                if not self._waitForLease():
+                    return
+
+        except Exception as e:
+            with self._Condition:
+                self.Errors.append((src, dst, str(e)))
+
+        finally:
+            with self._Condition:
+                self.Pending -= 1
+                self._Condition.notify_all()
+
+    def close(self):
+        with self._Condition:
+            self._Cancelled = True
+            self._Condition.notify_all()
+        self._Executor.shutdown(wait=True)
+
+
+def copytree(src, dst, symlinks=False, ignore=None, overwrite=False, make_safe_path=None, resume=False):
+    '''
+    generator, like ranger.ext.shutil_generatorized.copytree.
+
+    yields the number of bytes copied so far.
+    resume: see copyFile, applies with overwrite only.
+    '''
+    try:
+        os.makedirs(dst)
+    except OSError:
+        if not overwrite:
+            dst = getSafePath(dst, make_safe_path)
+            os.makedirs(dst)
+
+    copier = _Copier(resume and overwrite)
+    errors = []
+    dirs = []  # (src, dst, stat), metadata is copied after content
+    try:
+        copier.extend()
+
+        stack = [(src, dst, None)]
+        while len(stack) != 0:
+            srcDir, dstDir, st = stack.pop()
+            try:
+                if st is not None:
+                    try:
+                        os.mkdir(dstDir)
+                    except FileExistsError:
+                        if not overwrite or not os.path.isdir(dstDir):
+                            raise
+                else:
+                    st = os.stat(srcDir)
+                dirs.append((srcDir, dstDir, st))
+
+                with os.scandir(srcDir) as it:
+                    entries = list(it)
+            except OSError as e:
+                errors.append((srcDir, dstDir, str(e)))
+                continue
+
+            if ignore is not None:
+                ignoredNames = ignore(srcDir, [entry.name for entry in entries])
+                entries = [entry for entry in entries if entry.name not in ignoredNames]
+
+            for entry in entries:
+                srcName = entry.path
+                dstName = os.path.join(dstDir, entry.name)
+                try:
+                    if entry.is_symlink() and symlinks:
+                        _copySymlink(srcName, dstName, overwrite)
+                    elif entry.is_dir():
+                        stack.append((srcName, dstName, entry.stat()))
+                    elif entry.is_file():
+                        copier.submit(srcName, dstName)
+                    else:
+                        raise shutil.SpecialFileError('`{}` is not a regular file'.format(srcName))
+                except OSError as e:
+                    errors.append((srcName, dstName, str(e)))
+
+                while copier.MaxPending <= copier.Pending:
+                    copier.wait(YIELD_INTERVAL)
+                    yield copier.Done
+                    copier.extend()
+
+            yield copier.Done
+            copier.extend()
+
+        while copier.Pending != 0:
+            copier.wait(YIELD_INTERVAL)
+            yield copier.Done
+            copier.extend()
+
+        yield copier.Done
+
+    finally:
+        copier.close()
+
+    for srcDir, dstDir, st in reversed(dirs):
+        _copyMetadata(srcDir, dstDir, st)
+
+    errors.extend(copier.Errors)
+    if len(errors) != 0:
+        raise shutil.Error(errors)
+
+
+def move(src, dst, overwrite=False, make_safe_path=None):
+    '''
+    generator, like ranger.ext.shutil_generatorized.move.
+
+    never resumes, src is removed afterwards.
+    '''
+    realDst = dst
+    if os.path.isdir(dst):
+        if os.path.exists(src) and os.path.samefile(src, dst):
+            os.rename(src, dst)
+            return
+        realDst = os.path.join(dst, os.path.basename(src.rstrip(os.sep)))
+    if not overwrite:
+        realDst = getSafePath(realDst, make_safe_path)
+
+    try:
+        os.rename(src, realDst)
+        return
+    except OSError:
+        pass
+
+    if os.path.isdir(src) and not os.path.islink(src):
+        if (os.path.abspath(dst) + os.sep).startswith(os.path.abspath(src) + os.sep):
+            raise shutil.Error("Cannot move a directory '{}' into itself '{}'.".format(src, dst))
+        for n in copytree(src, realDst, symlinks=True, overwrite=overwrite, make_safe_path=make_safe_path):
+            yield n
+        shutil.rmtree(src)
+
+    else:
+        for n in copy2(src, realDst, symlinks=True, overwrite=overwrite, make_safe_path=make_safe_path):
+            yield n
+        os.unlink(src)
+
+
+def getSize(paths):
+    '''
+    returns the number of bytes copytree and copy2 copy, the exact counterpart of CopyLoader._calculate_size.
+    '''
+    r = 0
+    stack = list(paths)
+    while len(stack) != 0:
+        path = stack.pop()
+        try:
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                r += st.st_size
+            elif stat.S_ISDIR(st.st_mode):
+                with os.scandir(path) as it:
+                    stack.extend(entry.path for entry in it)
+        except OSError:
+            pass
+    return r
@@ -0,0 +1,183 @@
+'''
+batched file system operations for the sub processes, see external.batch_.
+
+- runBatch runs calls in a thread pool, in order where their paths overlap
+- rmtree unlinks the files of a tree in parallel
+'''
+
+import os
+import shutil
+
+THREADS = 8
+YIELD_INTERVAL = 0.05  # seconds between progress items
+
+
+def _getAncestors(path):
+    r = []
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return r
+        r.append(parent)
+        path = parent
+
+
+class _Runner:
+    '''
+    runs calls in a thread pool and keeps track of progress.
+    '''
+
+    Futures = None
+    Time = None
+
+    def __init__(self, threads=None):
+        if _Runner.Futures is None:
+            import concurrent.futures as futures
+            _Runner.Futures = futures
+            import time
+            _Runner.Time = time
+
+        if threads is None:
+            threads = THREADS
+        self.MaxPending = 4 * threads
+
+        self.Done = 0
+        self.Errors = []  # [(index, message)] since the last progress item
+
+        self._Executor = _Runner.Futures.ThreadPoolExecutor(max_workers=threads)
+        self._Futures = {}  # future: index
+        self._NextYield = 0
+
+    def submit(self, i, f, args, kwargs):
+        self._Futures[self._Executor.submit(f, *args, **kwargs)] = i
+
+    def drain(self, maxPending=0):
+        '''
+        generator, waits until at most maxPending calls are running.
+
+        yields progress items, see runBatch.
+        '''
+        futures = self._Futures
+        while maxPending < len(futures):
+            done, _ = _Runner.Futures.wait(futures, timeout=YIELD_INTERVAL,
+                                           return_when=_Runner.Futures.FIRST_COMPLETED)
+            for future in done:
+                i = futures.pop(future)
+                e = future.exception()
+                if e is not None:
+                    self.Errors.append((i, str(e)))
+                self.Done += 1
+
+            if self._NextYield <= _Runner.Time.monotonic():
+                yield self.getProgress()
+
+    def getProgress(self):
+        r = (self.Done, self.Errors)
+        self.Errors = []
+        self._NextYield = _Runner.Time.monotonic() + YIELD_INTERVAL
+        return r
+
+    def close(self):
+        for future in self._Futures:
+            future.cancel()
+        self._Executor.shutdown(wait=True)
+
+
+def runBatch(items, threads=None):
+    '''
+    generator, calls f(*args, **kwargs) for each item (f, args, kwargs, paths).
+
+    items run in parallel unless their paths are equal or nested, in the given order otherwise.
+    yields (number of items done, [(index, error message)]), errors since the previous item only.
+    '''
+    runner = _Runner(threads=threads)
+    try:
+        paths = set()  # of the items since the last barrier
+        ancestors = set()
+
+        for i, (f, args, kwargs, itemPaths) in enumerate(items):
+            overlaps = any(path in paths or path in ancestors or any(a in paths for a in _getAncestors(path))
+                           for path in itemPaths)
+            if overlaps:
+                for n in runner.drain():
+                    yield n
+                paths.clear()
+                ancestors.clear()
+
+            for n in runner.drain(runner.MaxPending - 1):
+                yield n
+
+            runner.submit(i, f, args, kwargs)
+            for path in itemPaths:
+                paths.add(path)
+                ancestors.update(_getAncestors(path))
+
+        for n in runner.drain():
+            yield n
+
+    finally:
+        runner.close()
+
+    yield runner.getProgress()
+
+
+def _unlinkAll(paths, errors):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            errors.append(e)
+
+
+def rmtree(path, ignore_errors=False, onerror=None, threads=None):
+    '''
+    like shutil.rmtree, unlinks the files of each directory in parallel.
+
+    raises the first error after removing everything else.
+    '''
+    if onerror is not None:
+        return shutil.rmtree(path, ignore_errors=ignore_errors, onerror=onerror)
+
+    import concurrent.futures as futures
+
+    if threads is None:
+        threads = THREADS
+
+    errors = []
+    try:
+        if os.path.islink(path):
+            raise OSError('Cannot call rmtree on a symbolic link')
+
+        dirs = []  # top down
+        with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            stack = [path]
+            while len(stack) != 0:
+                dirPath = stack.pop()
+                dirs.append(dirPath)
+
+                files = []
+                try:
+                    with os.scandir(dirPath) as it:
+                        for entry in it:
+                            try:
+                                isDir = entry.is_dir(follow_symlinks=False)
+                            except OSError:
+                                isDir = False
+                            (stack if isDir else files).append(entry.path)
+                except OSError as e:
+                    errors.append(e)
+
+                if len(files) != 0:
+                    executor.submit(_unlinkAll, files, errors)
+
+        for dirPath in reversed(dirs):
+            try:
+                os.rmdir(dirPath)
+            except OSError as e:
+                errors.append(e)
+
+    except OSError as e:
+        errors.append(e)
+
+    if len(errors) != 0 and not ignore_errors:
+        raise errors[0]
@@ -2,8 +2,13 @@
 RPC Stream Secure
 '''
 
+import os
 import threading
 import queue
+import selectors
+import struct
+import collections
+import time
 
 # import logging
 # logging.getLogger().setLevel(logging.DEBUG)
@@ -12,15 +17,31 @@ import queue
 # logging.getLogger().addHandler(logFile)
 
 
-def write(x, stream):
+FRAME_HEADER = struct.Struct('!I')  # length
+READ_SIZE = 2 ** 16
+
+# if not None: an object like shared.instrument.Metrics which records
+# - io.*: frames and bytes on the wire, encryption and handshake time
+# - rpc.*: latency of calls and items, pickling time, queue depths
+Metrics = None
+
+
+def _getName(f):
+    return getattr(f, '__name__', type(f).__name__)
+
+
+def write(x, stream, flush=True):
     '''
-    writes '{len(x)}\n{x}'.
+    writes FRAME_HEADER and x.
+
+    if not flush: leaves x in the buffer of stream.
     '''
     if isinstance(x, str):
         x = x.encode()
-    stream.write('{}\n'.format(len(x)).encode())
+    stream.write(FRAME_HEADER.pack(len(x)))
     stream.write(x)
-    stream.flush()
+    if flush:
+        stream.flush()
 
 
 class EOS(Exception):
@@ -28,84 +49,105 @@ class EOS(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
-def read(stream):
-    '''
-    reads '{len(x)}\n{x}' and returns x.
-
-    raises EOS.
-    '''
-    n = stream.readline()
-    if len(n) == 0:
-        raise EOS
-    n = int(n[:-1:])
-    r = stream.read(n)
-    return r
-
-
-class Reader(threading.Thread):
+class IO(object):
     '''
-    Thread.
+    container for both input and output stream.
 
-    readF shall raise EOS.
+    reads from the file descriptor of the input stream directly, so nothing may be read from the stream itself.
+    see read and write.
     '''
 
-    def __init__(self, readF, autostart=True):
-        threading.Thread.__init__(self)
-
-        self.ReadF = readF
-        self.Autostart = autostart
-
-        self.Queue = queue.Queue()
-        self.Stop = False
-        self.Exception = None
-
-        self.daemon = True
-
-        if autostart:
-            self.start()
-
-    def run(self):
-        try:
-            while True:
-                if self.Stop:
-                    break
+    def __init__(self, inStream, outStream):
+        self.InStream = inStream
+        self.OutStream = outStream
 
-                x = self.ReadF()
-                self.Queue.put(x)
-        except EOS:
-            pass
-        except Exception as e:
-            self.Exception = e
-            raise
+        self._InFd = inStream.fileno()
+        self._Buffer = bytearray(READ_SIZE)
+        self._Start = 0  # first unread byte
+        self._End = 0  # end of read bytes
+        self._Selector = selectors.DefaultSelector()
+        self._Selector.register(self._InFd, selectors.EVENT_READ)
 
-    def __del__(self):
-        if self.isAlive():
-            self.Stop = True
-            self.join()
+    def read(self, timeout=None):
+        '''
+        returns the next frame (bytearray), or None if none arrived within timeout seconds.
 
+        must not be called by more than one thread at a time.
+        raises EOS.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            r = self._nextFrame()
+            if r is not None:
+                metrics = Metrics
+                if metrics is not None:
+                    metrics.count('io.frames in')
+                    metrics.count('io.bytes in', FRAME_HEADER.size + len(r))
+                return r
+
+            if deadline is not None:
+                if len(self._Selector.select(max(0, deadline - time.monotonic()))) == 0:
+                    return None
+
+            self._fill()
+
+    def _nextFrame(self):
+        buffer = self._Buffer
+        start = self._Start
+        end = self._End
+        if end - start < FRAME_HEADER.size:
+            return None
+
+        n, = FRAME_HEADER.unpack_from(buffer, start)
+        start += FRAME_HEADER.size
+        if end - start < n:
+            return None
+
+        self._Start = start + n
+        return buffer[start:start + n]
+
+    def _fill(self):
+        '''
+        reads whatever is available, blocks if nothing is.
 
-class IO(object):
-    '''
-    container for both input and output stream.
+        raises EOS.
+        '''
+        buffer = self._Buffer
+        start = self._Start
+        end = self._End
 
-    uses functions read and write.
-    '''
+        # room for at least READ_SIZE bytes or the rest of the current frame
+        required = READ_SIZE
+        if FRAME_HEADER.size <= end - start:
+            n, = FRAME_HEADER.unpack_from(buffer, start)
+            required = max(required, FRAME_HEADER.size + n - (end - start))
 
-    def __init__(self, inStream, outStream):
-        self.InStream = inStream
-        self.OutStream = outStream
+        if len(buffer) - end < required:
+            buffer[:end - start] = buffer[start:end]
+            end -= start
+            self._Start = start = 0
+            self._End = end
+            if len(buffer) - end < required:
+                buffer.extend(bytes(required - (len(buffer) - end)))
 
-        self.InReader = inReader = Reader(self._read)
-        self.InQueue = inReader.Queue
+        with memoryview(buffer) as view:
+            n = os.readv(self._InFd, [view[end::]])
+        if n == 0:
+            raise EOS
+        self._End = end + n
 
-    def _read(self):
-        return read(self.InStream)
+    def write(self, x, flush=True):
+        metrics = Metrics
+        if metrics is not None:
+            metrics.count('io.frames out')
+            metrics.count('io.bytes out', FRAME_HEADER.size + len(x))
+        write(x, self.OutStream, flush=flush)
 
-    def write(self, x):
-        write(x, self.OutStream)
+    def flush(self):
+        self.OutStream.flush()
 
 
-AES_MAX_BYTES = 2 ^ 20  # 1MB
+AES_MAX_BYTES = 2 ** 20  # 1MB
 
 
 class EncryptedIO(IO):
@@ -126,7 +168,6 @@ class EncryptedIO(IO):
         if EncryptedIO.AES is None:
             import Crypto.Cipher.AES as aes
             EncryptedIO.AES = aes
-            import struct
             EncryptedIO.Struct = struct
 
         self._random = rand.new()
@@ -144,26 +185,16 @@ class EncryptedIO(IO):
         publicKey = privateKey.publickey().exportKey()
         IO.write(self, publicKey)
 
-        publicKey = self.InQueue.get()
-        publicKey = rsa.importKey(publicKey)
+        publicKey = rsa.importKey(bytes(IO.read(self)))
         self._writeCipher = pkcs1_oaep.new(publicKey)
 
-    def _read(self):
-        '''
-        plain read.
-        only called once.
-        '''
-        # eliminate race condition
-        while not hasattr(self, 'InReader'):
-            pass
-        self.InReader.ReadF = self._read_encrypted
-        return IO._read(self)
-
-    def _read_encrypted(self):
+    def read(self, timeout=None):
         '''
         see self.write
         '''
-        y = IO._read(self)
+        y = IO.read(self, timeout=timeout)
+        if y is None:
+            return None
 
         if self._nextReadRefresh < self._readByteCount:
             # a)
@@ -171,82 +202,279 @@ class EncryptedIO(IO):
             key, iv = keyIv[:16:], keyIv[16::]
             self._readCipher = EncryptedIO.AES.new(key, EncryptedIO.AES.MODE_CFB, iv)
 
-            # b)
-            y = IO._read(self)
+            # b), written along with a)
+            y = IO.read(self)
             t = self._readCipher.decrypt(y)
 
             self._readByteCount = 0
             self._nextReadRefresh = EncryptedIO.Struct.unpack('Q', t)[0] % AES_MAX_BYTES
 
-            return self._read_encrypted()
+            return self.read(timeout=timeout)
 
-        r = self._readCipher.decrypt(y)
+        metrics = Metrics
+        if metrics is None:
+            r = self._readCipher.decrypt(y)
+        else:
+            t = time.perf_counter()
+            r = self._readCipher.decrypt(y)
+            metrics.add('io.decrypt', time.perf_counter() - t)
         self._readByteCount += len(r)
         return r
 
-    def write(self, x):
+    def write(self, x, flush=True):
         '''
-        see self._read_encrypted
+        see self.read
         '''
+        if isinstance(x, str):
+            x = x.encode()
+
         if self._nextWriteRefresh < self._writeByteCount:
             # a)
             key = self._random.read(16)
             iv = self._random.read(EncryptedIO.AES.block_size)
 
             y = self._writeCipher.encrypt(key + iv)
-            IO.write(self, y)
+            IO.write(self, y, flush=False)
 
             self._writeCipher = EncryptedIO.AES.new(key, EncryptedIO.AES.MODE_CFB, iv)
 
             # b)
             t = self._random.read(8)
             y = self._writeCipher.encrypt(t)
-            IO.write(self, y)
+            IO.write(self, y, flush=False)
 
             self._writeByteCount = 0
             self._nextWriteRefresh = EncryptedIO.Struct.unpack('Q', t)[0] % AES_MAX_BYTES
 
         self._writeByteCount += len(x)
-        y = self._writeCipher.encrypt(x)
-        IO.write(self, y)
+        metrics = Metrics
+        if metrics is None:
+            y = self._writeCipher.encrypt(x)
+        else:
+            t = time.perf_counter()
+            y = self._writeCipher.encrypt(x)
+            metrics.add('io.encrypt', time.perf_counter() - t)
+        IO.write(self, y, flush=flush)
 
 
-class T(object):
+class _CryptodomeAead(object):
     '''
-    tag/token
+    AEAD of pycryptodome with the interface of cryptography's AEAD classes.
+
+    pycryptodome binds the nonce to the cipher object, so one is created per frame.
     '''
 
-    def __init__(self, id):
-        self.Id = id
+    def __init__(self, cipher, key):
+        self.Cipher = cipher
+        self.Key = key
 
-    def __eq__(self, other):
-        if not isT(other):
-            return False
-        return self.Id == other.Id
+    def _new(self, nonce):
+        if self.Cipher == 'aes-gcm':
+            return AeadIO.AES.new(self.Key, AeadIO.AES.MODE_GCM, nonce=nonce, mac_len=AeadIO.TAG_SIZE)
+        return AeadIO.ChaCha20_Poly1305.new(key=self.Key, nonce=nonce)
 
-    def __hash__(self):
-        return hash(self.Id)
+    def encrypt(self, nonce, x, associatedData):
+        y, tag = self._new(nonce).encrypt_and_digest(x)
+        return y + tag
 
-    def __repr__(self):
-        return 'T({})'.format(repr(self.Id))
+    def decrypt(self, nonce, y, associatedData):
+        view = memoryview(y)
+        return self._new(nonce).decrypt_and_verify(view[:-AeadIO.TAG_SIZE:], view[-AeadIO.TAG_SIZE::])
 
 
-def isT(x):
-    # type(x) == T fails due to pickling/unpickling
-    return type(x).__name__ == 'T'
+class AeadIO(IO):
+    '''
+    uses ephemeral ECDH (init) and AES-GCM or ChaCha20-Poly1305 (read/write) encryption.
 
+    keys are ratcheted with HKDF every REKEY_FRAMES frames or REKEY_BYTES bytes, on both sides alike.
+    frames are encrypted with the package cryptography if available (one AEAD object per key,
+    about 2-3 µs per small frame), with pycryptodome otherwise (about 50-100 µs), see _CryptodomeAead.
+    both produce the same frames.
+    '''
 
-Tpass = T('pass')
-Tinterval = T('interval')
-Ttimeout = T('timeout')
-Tpause = T('pause')
-Tcall = T('call')
-Tcall_iter = T('call_iter')
-Tend = T('end')
-Tcall_step = T('call_step')
-Tnext = T('next')
-Texception = T('exception')
-Tstop = T('stop')
+    ECC = None
+    HKDF = None
+    SHA256 = None
+    AES = None
+    ChaCha20_Poly1305 = None
+    Aeads = None  # cipher: AEAD class of cryptography
+    InvalidTag = None
+
+    REKEY_FRAMES = 2 ** 32
+    REKEY_BYTES = 2 ** 34  # 16GB
+    TAG_SIZE = 16
+    NONCE = struct.Struct('!4xQ')
+
+    def __init__(self, inStream, outStream, cipher='aes-gcm'):
+        if AeadIO.ECC is None:
+            import Crypto.PublicKey.ECC as ecc
+            AeadIO.ECC = ecc
+            import Crypto.Protocol.KDF as kdf
+            AeadIO.HKDF = kdf.HKDF
+            import Crypto.Hash.SHA256 as sha256
+            AeadIO.SHA256 = sha256
+            import Crypto.Cipher.AES as aes
+            AeadIO.AES = aes
+            import Crypto.Cipher.ChaCha20_Poly1305 as chacha20_poly1305
+            AeadIO.ChaCha20_Poly1305 = chacha20_poly1305
+
+            try:
+                import cryptography.hazmat.primitives.ciphers.aead as aead
+                import cryptography.exceptions as exceptions
+            except ImportError:
+                AeadIO.Aeads = {}
+                AeadIO.InvalidTag = ValueError
+            else:
+                AeadIO.Aeads = {'aes-gcm': aead.AESGCM, 'chacha20': aead.ChaCha20Poly1305}
+                AeadIO.InvalidTag = exceptions.InvalidTag
+
+        if cipher not in ('aes-gcm', 'chacha20'):
+            raise ValueError('unknown cipher {}'.format(cipher))
+        self.Cipher = cipher
+
+        privateKey = AeadIO.ECC.generate(curve='P-256')
+        point = privateKey.pointQ
+        publicKey = point.x.to_bytes(32) + point.y.to_bytes(32)
+        self._readFrameCount = 0
+        self._readByteCount = 0
+        self._writeFrameCount = 0
+        self._writeByteCount = 0
+
+        IO.__init__(self, inStream, outStream)
+
+        IO.write(self, publicKey)
+        peerPublicKey = bytes(IO.read(self))
+
+        x, y = int.from_bytes(peerPublicKey[:32:], 'big'), int.from_bytes(peerPublicKey[32::], 'big')
+        peerKey = AeadIO.ECC.construct(curve='P-256', point_x=x, point_y=y)  # validates point
+        secret = (peerKey.pointQ * privateKey.d).x.to_bytes(32)
+        self._writeKey = self._deriveKey(secret, publicKey + peerPublicKey)
+        self._readKey = self._deriveKey(secret, peerPublicKey + publicKey)
+        self._writeAead = self._newAead(self._writeKey)
+        self._readAead = self._newAead(self._readKey)
+
+    def read(self, timeout=None):
+        y = IO.read(self, timeout=timeout)
+        if y is None:
+            return None
+        return self._decrypt(y)
+
+    def _deriveKey(self, secret, salt, context=b'rpcss'):
+        return AeadIO.HKDF(secret, 32, salt, AeadIO.SHA256, context=context)
+
+    def _newAead(self, key):
+        aead = AeadIO.Aeads.get(self.Cipher)
+        if aead is None:
+            return _CryptodomeAead(self.Cipher, key)
+        return aead(key)
+
+    def _decrypt(self, y):
+        if self._readFrameCount == AeadIO.REKEY_FRAMES or AeadIO.REKEY_BYTES <= self._readByteCount:
+            self._readKey = self._deriveKey(self._readKey, b'', context=b'rekey')
+            self._readAead = self._newAead(self._readKey)
+            self._readFrameCount = 0
+            self._readByteCount = 0
+
+        metrics = Metrics
+        if metrics is not None:
+            t = time.perf_counter()
+
+        try:
+            r = self._readAead.decrypt(AeadIO.NONCE.pack(self._readFrameCount), y, None)
+        except AeadIO.InvalidTag:
+            raise ValueError('MAC check failed')
+
+        if metrics is not None:
+            metrics.add('io.decrypt', time.perf_counter() - t)
+
+        self._readFrameCount += 1
+        self._readByteCount += len(r)
+        return r
+
+    def write(self, x, flush=True):
+        if isinstance(x, str):
+            x = x.encode()
+
+        if self._writeFrameCount == AeadIO.REKEY_FRAMES or AeadIO.REKEY_BYTES <= self._writeByteCount:
+            self._writeKey = self._deriveKey(self._writeKey, b'', context=b'rekey')
+            self._writeAead = self._newAead(self._writeKey)
+            self._writeFrameCount = 0
+            self._writeByteCount = 0
+
+        metrics = Metrics
+        if metrics is not None:
+            t = time.perf_counter()
+
+        y = self._writeAead.encrypt(AeadIO.NONCE.pack(self._writeFrameCount), x, None)
+
+        if metrics is not None:
+            metrics.add('io.encrypt', time.perf_counter() - t)
+            metrics.count('io.frames out')
+            metrics.count('io.bytes out', FRAME_HEADER.size + len(y))
+
+        self._writeFrameCount += 1
+        self._writeByteCount += len(x)
+
+        stream = self.OutStream
+        stream.write(FRAME_HEADER.pack(len(y)))
+        stream.write(y)
+        if flush:
+            stream.flush()
+
+
+def _aesGcmIO(inStream, outStream):
+    return AeadIO(inStream, outStream, cipher='aes-gcm')
+
+
+def _chacha20IO(inStream, outStream):
+    return AeadIO(inStream, outStream, cipher='chacha20')
+
+
+TRANSPORTS = {
+    'plain': IO,
+    'rsa': EncryptedIO,
+    'aes-gcm': _aesGcmIO,
+    'chacha20': _chacha20IO,
+}
+
+
+def createIO(transport, inStream, outStream):
+    '''
+    returns TRANSPORTS[transport](inStream, outStream).
+
+    both sides must use the same transport.
+    '''
+    metrics = Metrics
+    if metrics is None:
+        return TRANSPORTS[transport](inStream, outStream)
+
+    t = time.perf_counter()
+    r = TRANSPORTS[transport](inStream, outStream)
+    metrics.add('io.handshake ' + transport, time.perf_counter() - t)
+    return r
+
+
+'''
+message types
+
+a message is a single frame: MESSAGE_HEADER (request id, type) followed by the pickled payload, if any.
+request id 0 addresses the connection rather than a request.
+
+the client sends the items of a call_iter only while it has credit:
+Tcall_iter carries the initial limit, Tcredit a new limit (the number of items it may send in total).
+'''
+MESSAGE_HEADER = struct.Struct('!IB')
+
+Tpass = 0
+Ttimeout = 1
+Tcall = 2
+Tcall_iter = 3
+Tcredit = 4
+Tresult = 5
+Tend = 6
+Texception = 7
+Tclose = 8
+Tstop = 9
 
 
 class _RpcBase(object):
@@ -255,123 +483,405 @@ class _RpcBase(object):
     def __init__(self, io):
         self.IO = io
 
-        self._InQueue = io.InQueue
+        self._WriteLock = threading.Lock()
+        self._WritersLock = threading.Lock()
+        self._Writers = 0
 
         if _RpcBase.Pickle is None:
             import pickle
             _RpcBase.Pickle = pickle
 
-    def _read(self, block=True, timeout=None):
-        while True:
-            r = self._readWithPass(block=block, timeout=timeout)
-            if r == Tpass:
-                continue
-            return r
+    def _write(self, id, type, x=None):
+        '''
+        flushes only if no other thread is waiting to write.
+        '''
+        y = self._encode(id, type, x)
 
-    def _readWithPass(self, block=True, timeout=None):
-        r = self._InQueue.get(block=block, timeout=timeout)
-        return _RpcBase.Pickle.loads(r)
+        with self._WritersLock:
+            self._Writers += 1
+            writers = self._Writers
 
-    def _write(self, x):
-        x = _RpcBase.Pickle.dumps(x)
-        self.IO.write(x)
+        metrics = Metrics
+        if metrics is not None:
+            metrics.gauge('rpc.writers', writers)
 
-    def pass_(self):
+        with self._WriteLock:
+            with self._WritersLock:
+                self._Writers -= 1
+                flush = self._Writers == 0
+
+            self._beforeWrite()
+            self.IO.write(y, flush=flush)
+
+    def _beforeWrite(self):
         '''
-        does nothing.
+        called with the write lock acquired.
+        '''
+        pass
 
-        fails if the connection is down.
+    def _encode(self, id, type, x=None):
+        header = MESSAGE_HEADER.pack(id, type)
+        if x is None:
+            return header
+
+        metrics = Metrics
+        if metrics is None:
+            return header + _RpcBase.Pickle.dumps(x)
+
+        t = time.perf_counter()
+        r = header + _RpcBase.Pickle.dumps(x)
+        metrics.add('rpc.pickle', time.perf_counter() - t)
+        return r
+
+    def _decode(self, frame):
         '''
-        self._write(Tpass)
+        returns (id, type, payload).
+        '''
+        id, type = MESSAGE_HEADER.unpack_from(frame)
+        if len(frame) == MESSAGE_HEADER.size:
+            return id, type, None
 
+        metrics = Metrics
+        if metrics is None:
+            return id, type, _RpcBase.Pickle.loads(memoryview(frame)[MESSAGE_HEADER.size::])
 
-class RpcServer(_RpcBase):
-    def __init__(self, io):
-        _RpcBase.__init__(self, io)
+        t = time.perf_counter()
+        x = _RpcBase.Pickle.loads(memoryview(frame)[MESSAGE_HEADER.size::])
+        metrics.add('rpc.unpickle', time.perf_counter() - t)
+        return id, type, x
+
+
+class Stream(object):
+    '''
+    iterator over the items of a remote call_iter.
+
+    grants credit for Window items ahead of consumption, or for one item on each next if Window is 0.
+    see RpcServer.call_iter.
+    '''
+
+    def __init__(self, rpcServer, id, window, pause):
+        self.RpcServer = rpcServer
+        self.Id = id
+        self.Window = window
+
+        self.Paused = pause
+        self.Consumed = 0
+        self.Limit = 0 if pause else window
+        self.Ended = False
+
+        self.Name = None  # see Metrics
 
-    def setInterval(self, interval):
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.Ended:
+            raise StopIteration
+
+        rpcServer = self.RpcServer
+        metrics = Metrics
+        if metrics is not None:
+            t = time.perf_counter()
+        try:
+            self._step()
+            type, x = rpcServer._receive(self.Id)
+        except BaseException:
+            self.close()
+            raise
+
+        if metrics is not None:
+            metrics.add('rpc.call_iter item ' + self.Name, time.perf_counter() - t)
+
+        if type == Tresult:
+            self.Consumed += 1
+            if self.Window != 0 and not self.Paused and self.Limit - self.Consumed <= self.Window // 2:
+                self._grant(self.Consumed + self.Window)
+            return x
+
+        self._end()
+        if type == Texception:
+            raise x
+        raise StopIteration
+
+    def _step(self):
+        if self.Window == 0 and not self.Paused and self.Limit == self.Consumed:
+            self._grant(self.Consumed + 1)
+
+    def _grant(self, limit):
+        self.Limit = limit
+        self.RpcServer._write(self.Id, Tcredit, limit)
+
+    def wait(self, timeout=None):
         '''
-        see RpcClient.
+        returns True as soon as next won't block, False after timeout seconds.
         '''
-        self._write(Tinterval)
-        self._write(interval)
+        if self.Ended:
+            return True
 
-    def setTimeout(self, timeout):
+        self._step()
+        try:
+            return self.RpcServer._wait(self.Id, timeout=timeout)
+        except EOS:
+            return True
+
+    def hasInput(self):
         '''
-        see RpcClient.
+        for non-blocking use.
         '''
-        self._write(Ttimeout)
-        self._write(timeout)
+        return self.wait(timeout=0)
 
     def setPause(self, value):
         '''
-        see RpcClient.
+        revokes or restores credit.
+
+        items already sent are still received.
         '''
-        self._write(Tpause)
-        self._write(value)
+        if self.Ended or value == self.Paused:
+            return
+        self.Paused = value
 
-    def call(self, f, args=tuple(), kwargs=dict()):
-        self._write(Tcall)
-        self._write((f, args, kwargs))
+        if value:
+            self._grant(self.Consumed)
+        elif self.Window != 0:
+            self._grant(self.Consumed + self.Window)
+
+    def close(self):
+        '''
+        stops the remote iterator.
+        '''
+        if self.Ended:
+            return
+        self._end()
 
-        r = self._read()
-        if r == Texception:
-            raise self._read()
+        try:
+            self.RpcServer._write(self.Id, Tclose)
+        except IOError:
+            pass
 
-        return r
+    def _end(self):
+        self.Ended = True
+        self.RpcServer._closeRequest(self.Id)
 
-    def call_iter(self, f, args=tuple(), kwargs=dict()):
+    def __del__(self):
+        if self.Ended:
+            return
+        self.Ended = True
+
+        # may be called during a write, so don't write
+        self.RpcServer._abandonRequest(self.Id)
+
+
+class RpcServer(_RpcBase):
+    '''
+    calls may be issued from several threads at once.
+
+    the thread waiting for a message reads from IO and routes messages to the other requests.
+    '''
+
+    Weakref = None
+
+    def __init__(self, io):
+        _RpcBase.__init__(self, io)
+
+        if RpcServer.Weakref is None:
+            import weakref
+            RpcServer.Weakref = weakref
+
+        self.Pause = False
+
+        self._Condition = threading.Condition()
+        self._NextId = 1
+        self._Requests = {}  # id: collections.deque
+        self._Streams = RpcServer.Weakref.WeakValueDictionary()  # id: Stream
+        self._Reading = False
+        self._Eos = False
+        self._Abandoned = collections.deque()  # ids to close
+
+    def _beforeWrite(self):
+        abandoned = self._Abandoned
+        while len(abandoned) != 0:
+            self.IO.write(self._encode(abandoned.popleft(), Tclose), flush=False)
+
+    def _openRequest(self):
+        with self._Condition:
+            id = self._NextId
+            self._NextId = id % 0xffffffff + 1
+            self._Requests[id] = collections.deque()
+            n = len(self._Requests)
+
+        metrics = Metrics
+        if metrics is not None:
+            metrics.gauge('rpc.requests', n)
+        return id
+
+    def _closeRequest(self, id):
+        with self._Condition:
+            self._Requests.pop(id, None)
+
+    def _abandonRequest(self, id):
+        '''
+        closes request id on next write.
         '''
-        yields items that f(*args, **kwargs) yields.
+        self._Requests.pop(id, None)
+        self._Abandoned.append(id)
 
-        remote produces items continously.
-        see self.setPause.
+    def _receive(self, id):
         '''
-        self._write(Tcall_iter)
-        self._write((f, args, kwargs))
+        returns (type, payload) of the next message for request id.
 
-        while True:
-            n = self._read()
-            if isT(n):
-                if n == Tend:
-                    break
+        raises EOS.
+        '''
+        self._wait(id)
+        with self._Condition:
+            return self._Requests[id].popleft()
 
-                if n == Texception:
-                    raise self._read()
+    def _wait(self, id, timeout=None):
+        '''
+        returns True as soon as a message for request id is available, False after timeout seconds.
 
-            yield n
+        raises EOS if none is available.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        condition = self._Condition
+        with condition:
+            messages = self._Requests[id]
+            while True:
+                if len(messages) != 0:
+                    return True
+
+                if self._Eos:
+                    raise EOS
+
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+
+                if self._Reading:
+                    if remaining == 0:
+                        return False
+                    condition.wait(remaining)
+                    continue
+
+                self._Reading = True
+                condition.release()
+                try:
+                    frame = self.IO.read(timeout=remaining)
+                except EOS:
+                    frame = None
+                    self._Eos = True
+                finally:
+                    condition.acquire()
+                    self._Reading = False
+                    condition.notify_all()
+
+                if frame is not None:
+                    self._route(frame)
+                elif not self._Eos:  # timeout
+                    return False
+
+    def _route(self, frame):
+        id, type, x = self._decode(frame)
+        messages = self._Requests.get(id)
+        if messages is None:  # closed
+            return
+        messages.append((type, x))
 
-    def hasInput(self):
+        metrics = Metrics
+        if metrics is not None:
+            metrics.gauge('rpc.queue', len(messages))
+
+    def hasInput(self, id):
         '''
-        for non-blocking use of call_iter.
+        returns True if a message for request id is available.
         '''
-        return not self._InQueue.empty()
+        try:
+            return self._wait(id, timeout=0)
+        except EOS:
+            return True
 
-    def call_step(self, f, args=tuple(), kwargs=dict()):
+    def pass_(self):
         '''
-        yields items that f(*args, **kwargs) yields.
+        does nothing.
 
-        remote produces items stepwise on next.
+        fails if the connection is down.
         '''
-        self._write(Tcall_step)
-        self._write((f, args, kwargs))
+        self._write(0, Tpass)
 
-        init = self._read()
-        if init == Texception:
-            raise self._read()
+    def setTimeout(self, timeout):
+        '''
+        see RpcClient.
+        '''
+        self._write(0, Ttimeout, timeout)
 
-        while True:
-            self._write(Tnext)
+    def setPause(self, value, id=0):
+        '''
+        pauses/resumes stream id, or all streams including future ones if id is 0.
 
-            n = self._read()
-            if isT(n):
-                if n == Tend:
-                    break
+        see Stream.setPause.
+        '''
+        with self._Condition:
+            if id == 0:
+                self.Pause = value
+                streams = list(self._Streams.values())
+            else:
+                stream = self._Streams.get(id)
+                streams = [] if stream is None else [stream]
+
+        for stream in streams:
+            stream.setPause(value)
+
+    def closeStreams(self):
+        '''
+        closes all streams.
+        '''
+        with self._Condition:
+            streams = list(self._Streams.values())
 
-                if n == Texception:
-                    raise self._read()
+        for stream in streams:
+            stream.close()
 
-            yield n
+    def call(self, f, args=tuple(), kwargs=dict()):
+        metrics = Metrics
+        if metrics is not None:
+            t = time.perf_counter()
+
+        id = self._openRequest()
+        try:
+            self._write(id, Tcall, (f, args, kwargs))
+
+            type, x = self._receive(id)
+        finally:
+            self._closeRequest(id)
+
+        if metrics is not None:
+            metrics.add('rpc.call ' + _getName(f), time.perf_counter() - t)
+
+        if type == Texception:
+            raise x
+
+        return x
+
+    def call_iter(self, f, args=tuple(), kwargs=dict(), window=16, interval=None):
+        '''
+        returns a Stream of the items that f(*args, **kwargs) yields.
+
+        remote produces up to window items ahead, see Stream.
+        if interval is not None: remote sends at most one item per interval seconds, the latest,
+        and always the last one.
+        see self.setPause.
+        '''
+        id = self._openRequest()
+        with self._Condition:
+            r = self._Streams[id] = Stream(self, id, window, self.Pause)
+        r.Name = _getName(f)
+        self._write(id, Tcall_iter, (f, args, kwargs, r.Limit, interval))
+        return r
+
+    def call_step(self, f, args=tuple(), kwargs=dict()):
+        '''
+        returns a Stream of the items that f(*args, **kwargs) yields.
+
+        remote produces items stepwise on next.
+        '''
+        return self.call_iter(f, args, kwargs, window=0)
 
     def addToPath(self, x):
         '''
@@ -427,157 +937,213 @@ class RpcServer(_RpcBase):
         self.call(_chdir, (to,))
 
     def stop(self):
-        self._write(Tstop)
+        self._write(0, Tstop)
+
+
+class _Request(object):
+    '''
+    state of a request on client side.
+
+    Limit is None for requests without flow control.
+    '''
+
+    def __init__(self, id, limit=None, interval=None):
+        self.Id = id
+        self.Limit = limit
+        self.Interval = interval
+
+        self.Sent = 0
+        self.Closed = False
+        self.Condition = threading.Condition()
+
+    def setLimit(self, limit):
+        with self.Condition:
+            self.Limit = limit
+            self.Condition.notify()
+
+    def waitForCredit(self):
+        '''
+        returns False if closed.
+        '''
+        with self.Condition:
+            while not self.Closed and self.Limit <= self.Sent:
+                self.Condition.wait()
+            return not self.Closed
+
+    def close(self):
+        with self.Condition:
+            self.Closed = True
+            self.Condition.notify()
 
 
 class RpcClient(_RpcBase):
-    def __init__(self, io, interval=0.33, timeout=60):
+    '''
+    runs requests in worker threads, idle workers are reused.
+
+    main stops after Timeout seconds without input if no request is running.
+    '''
+
+    def __init__(self, io, timeout=60):
         _RpcBase.__init__(self, io)
 
-        self.Interval = interval
         self.Timeout = timeout
 
-        self.Pause = False
         self.Stop = False
 
-        self.StepGen = None
+        self._Requests = {}  # id: _Request
+        self._Tasks = queue.Queue()
+        self._IdleWorkers = 0
+        self._WorkerLock = threading.Lock()
 
     _Dos = {}
 
     def main(self):
-        i = 0
-        while True:
-            if self.Stop:
-                break
-
-            try:
-                t = self._readWithPass(block=True, timeout=self.Interval)
-            except queue.Empty:
-                if (self.Timeout / self.Interval) < i and self.StepGen is None:
+        try:
+            while not self.Stop:
+                try:
+                    frame = self.IO.read(timeout=self.Timeout)
+                except EOS:
                     break
 
-                i += 1
-                continue
+                if frame is None:  # timeout
+                    if len(self._Requests) == 0:
+                        break
+                    continue
+
+                id, type, x = self._decode(frame)
+                RpcClient._Dos[type](self, id, x)
 
-            i = 0
-            RpcClient._Dos[t](self)
+        finally:
+            for request in list(self._Requests.values()):
+                request.close()
 
-    def _do_pass(self):
+    def _do_pass(self, id, x):
         pass
     _Dos[Tpass] = _do_pass
 
-    def _do_setInterval(self):
-        self.Interval = self._read()
-    _Dos[Tinterval] = _do_setInterval
-
-    def _do_setTimeout(self):
-        self.Timeout = self._read()
+    def _do_setTimeout(self, id, x):
+        self.Timeout = x
     _Dos[Ttimeout] = _do_setTimeout
 
-    def _do_setPause(self):
-        self.Pause = self._read()
-    _Dos[Tpause] = _do_setPause
-
-    def _do_call(self):
-        data = self._read()
-        f, args, kwargs = data
-
-        try:
-            r = f(*args, **kwargs)
-        except Exception as e:
-            self._write_exception(e)
-            return
-
-        self._write(r)
+    def _do_call(self, id, x):
+        self._startRequest(_Request(id), self._call, x)
     _Dos[Tcall] = _do_call
 
-    def _do_call_iter(self):
-        data = self._read()
-        f, args, kwargs = data
+    def _do_call_iter(self, id, x):
+        f, args, kwargs, limit, interval = x
+        self._startRequest(_Request(id, limit=limit, interval=interval), self._call_iter, (f, args, kwargs))
+    _Dos[Tcall_iter] = _do_call_iter
 
-        try:
-            r = f(*args, **kwargs)
-        except Exception as e:
-            self._write_exception(e)
-            return
+    def _do_credit(self, id, x):
+        request = self._Requests.get(id)
+        if request is not None:
+            request.setLimit(x)
+    _Dos[Tcredit] = _do_credit
 
-        while True:
-            self._call_iter_handleInput()
+    def _do_close(self, id, x):
+        request = self._Requests.get(id)
+        if request is not None:
+            request.close()
+    _Dos[Tclose] = _do_close
 
-            if self.Stop:
-                return
+    def _do_stop(self, id, x):
+        self.Stop = True
+    _Dos[Tstop] = _do_stop
 
-            if self.Pause:
-                continue
+    def _startRequest(self, request, runF, data):
+        self._Requests[request.Id] = request
 
-            try:
-                n = next(r)
-            except StopIteration:
-                break
-            except Exception as e:
-                self._write_exception(e)
-                return
+        with self._WorkerLock:
+            spawn = self._IdleWorkers == 0
+            if not spawn:
+                self._IdleWorkers -= 1
 
-            self._write(n)
+        self._Tasks.put((runF, request, data))
 
-        self._write(Tend)
-    _Dos[Tcall_iter] = _do_call_iter
+        if spawn:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
 
-    def _call_iter_handleInput(self):
+    def _work(self):
+        tasks = self._Tasks
         while True:
-            try:
-                t = self._read(block=True, timeout=self.Interval if self.Pause else 0)
-            except queue.Empty:
-                return
+            self._runRequest(*tasks.get())
 
-            if not (t == Tpause or t == Tstop):
-                raise Exception('recieved unexpected token {}'.format(t))
+            with self._WorkerLock:
+                self._IdleWorkers += 1
 
-            RpcClient._Dos[t](self)
-
-    def _do_call_step(self):
-        data = self._read()
+    def _runRequest(self, runF, request, data):
         f, args, kwargs = data
-
         try:
-            r = f(*args, **kwargs)
+            runF(request, f(*args, **kwargs))
         except Exception as e:
-            self._write_exception(e)
-            return
+            self._write_exception(request.Id, e)
+        finally:
+            self._Requests.pop(request.Id, None)
+
+    def _call(self, request, r):
+        self._write(request.Id, Tresult, r)
 
-        self.StepGen = r
-        self._write(Tnext)  # init
-    _Dos[Tcall_step] = _do_call_step
+    def _call_iter(self, request, r):
+        '''
+        sends items while there is credit.
 
-    def _do_next(self):
+        with an interval, items in between are dropped, see RpcServer.call_iter.
+        closes r when done, so generators clean up right away.
+        '''
         try:
-            n = next(self.StepGen)
-        except StopIteration:
-            n = Tend
-        except Exception as e:
-            self._write_exception(e)
-            self.StepGen = None
-            return
+            self._send_iter(request, r)
+        finally:
+            close = getattr(r, 'close', None)
+            if close is not None:
+                close()
+
+    def _send_iter(self, request, r):
+        id = request.Id
+        interval = request.Interval
+        nextTime = 0
+        pending = False
 
-        self._write(n)
-    _Dos[Tnext] = _do_next
+        while True:
+            if not request.waitForCredit():
+                return
 
-    def _do_stop(self):
-        self.Stop = True
-    _Dos[Tstop] = _do_stop
+            try:
+                n = next(r)
+            except StopIteration:
+                break
+
+            if interval is not None:
+                t = time.monotonic()
+                if t < nextTime:
+                    pending = True
+                    continue
+                nextTime = t + interval
+                pending = False
+
+            request.Sent += 1
+            self._write(id, Tresult, n)
 
-    def _write_exception(self, e):
+        if pending:
+            if not request.waitForCredit():
+                return
+            request.Sent += 1
+            self._write(id, Tresult, n)
+
+        self._write(id, Tend)
+
+    def _write_exception(self, id, e):
         import traceback
         e.ExceptionStr = traceback.format_exc()
-        self._write(Texception)
-        self._write(e)
+        self._write(id, Texception, e)
 
 
 if __name__ == '__main__':
     #import sys
 
     #io = RpcClient(EncryptedIO(sys.stdin, sys.stdout))
-    # io.join()
+    # io.main()
 
     if True:
         import sys
@@ -590,7 +1156,7 @@ if __name__ == '__main__':
 
             io = cl(sys.stdin.buffer, sys.stdout.buffer)
 
-            io.write(io.InQueue.get())
+            io.write(io.read())
             io.write('Message from child to parent')
 
             exit()
@@ -603,15 +1169,14 @@ if __name__ == '__main__':
 
             io.write('Message from parent to child')
 
-            print(io.InQueue.get())
-            print(io.InQueue.get())
+            print(io.read())
+            print(io.read())
 
             exit()
 
     if False:
         import sys
         import subprocess as sub
-        import time
 
         cl = EncryptedIO
 
@@ -621,7 +1186,7 @@ if __name__ == '__main__':
             io = cl(sys.stdin.buffer, sys.stdout.buffer)
 
             client = RpcClient(io)
-            client.join()
+            client.main()
 
             exit()
 
@@ -645,7 +1210,6 @@ if __name__ == '__main__':
             server.addToPath('..')
             server.chdir('..')
 
-            server.setInterval(0)
             server.setTimeout(5)
             time.sleep(4)
 
@@ -669,8 +1233,6 @@ if __name__ == '__main__':
             for i in server.call_step(f):
                 print(i)
 
-            server.setInterval(0.03)
-
             server.stop()
 
             exit()
@@ -1,5 +1,7 @@
 import ranger.api.commands as commands
 
+import os
+
 
 class SuperCommand(commands.Command):
     '''
@@ -42,3 +44,36 @@ class SuperCommand(commands.Command):
         if isinstance(r, str):
             return '{} {}'.format(name, r)
         return ('{} {}'.format(name, sub) for sub in r)
+
+
+class metrics(commands.Command):
+    '''
+    :metrics [reset | dump [path]]
+
+    shows, resets or dumps the metrics of instrument.Active, see external.enableMetrics.
+    '''
+
+    def execute(self):
+        from . import instrument
+
+        metrics = instrument.Active
+        if metrics is None:
+            self.fm.notify('metrics are disabled, see external.enableMetrics', bad=True)
+            return
+
+        action = self.arg(1)
+        if action == 'reset':
+            metrics.reset()
+            return
+
+        if action == 'dump':
+            path = self.rest(2)
+            path = metrics.dump(path=os.path.expanduser(path) if len(path) != 0 else None)
+            self.fm.notify('metrics written to {}'.format(path))
+            return
+
+        pager = self.fm.ui.open_pager()
+        pager.set_source(metrics.getReport())
+
+    def tab(self, tabnum):
+        return ('metrics {}'.format(action) for action in ('reset', 'dump') if action.startswith(self.arg(1)))
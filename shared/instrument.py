@@ -0,0 +1,196 @@
+'''
+optional instrumentation.
+
+Active is None unless enabled, so instrumented code checks it first:
+
+    metrics = instrument.Active
+    if metrics is not None:
+        metrics.add('name', seconds)
+
+does not depend on ranger, see external/benchmark.py.
+'''
+
+import os
+import threading
+import time
+
+
+def getDefaultPath():
+    cacheHome = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheHome, 'ranger-ext', 'metrics.json')
+
+
+class Histogram:
+    '''
+    histogram of durations.
+
+    bucket i counts durations in [2 ** (i - 1), 2 ** i) microseconds, bucket 0 those below one microsecond.
+    '''
+
+    def __init__(self):
+        self.Count = 0
+        self.Sum = 0.
+        self.Min = None
+        self.Max = None
+        self.Buckets = []
+
+    def add(self, seconds, count=1):
+        '''
+        adds count durations of seconds each.
+        '''
+        i = int(seconds * 1e6).bit_length()
+        buckets = self.Buckets
+        if len(buckets) <= i:
+            buckets.extend([0] * (i + 1 - len(buckets)))
+        buckets[i] += count
+
+        self.Count += count
+        self.Sum += count * seconds
+        if self.Min is None or seconds < self.Min:
+            self.Min = seconds
+        if self.Max is None or self.Max < seconds:
+            self.Max = seconds
+
+    def getPercentile(self, q):
+        '''
+        returns the upper bound of the bucket containing the q-th percentile, in seconds.
+        '''
+        if self.Count == 0:
+            return None
+
+        n = q / 100 * self.Count
+        total = 0
+        for i, count in enumerate(self.Buckets):
+            total += count
+            if n <= total:
+                return min(2 ** i * 1e-6, self.Max)
+        return self.Max
+
+    def getState(self):
+        return {'count': self.Count, 'sum': self.Sum, 'min': self.Min, 'max': self.Max,
+                'p50': self.getPercentile(50), 'p99': self.getPercentile(99), 'buckets': self.Buckets}
+
+
+class Metrics:
+    '''
+    named histograms (see add), counters (see count) and gauges (see gauge).
+
+    may be used from several threads at once.
+    '''
+
+    def __init__(self):
+        self._Lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._Lock:
+            self.Start = time.time()
+            self._Histograms = {}  # name: Histogram
+            self._Counters = {}  # name: int
+            self._Gauges = {}  # name: [last, max]
+
+    def add(self, name, seconds, count=1):
+        '''
+        adds count durations of seconds each to histogram name.
+        '''
+        with self._Lock:
+            histogram = self._Histograms.get(name)
+            if histogram is None:
+                histogram = self._Histograms[name] = Histogram()
+            histogram.add(seconds, count=count)
+
+    def count(self, name, n=1):
+        with self._Lock:
+            self._Counters[name] = self._Counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        '''
+        sets gauge name, which keeps the maximum too.
+        '''
+        with self._Lock:
+            gauge = self._Gauges.get(name)
+            if gauge is None:
+                self._Gauges[name] = [value, value]
+            else:
+                gauge[0] = value
+                if gauge[1] < value:
+                    gauge[1] = value
+
+    def getState(self):
+        '''
+        returns a json serializable dict.
+        '''
+        with self._Lock:
+            return {
+                'start': self.Start,
+                'duration': time.time() - self.Start,
+                'histograms': {name: histogram.getState() for name, histogram in self._Histograms.items()},
+                'counters': dict(self._Counters),
+                'gauges': {name: {'last': last, 'max': max_} for name, (last, max_) in self._Gauges.items()},
+            }
+
+    def getReport(self):
+        '''
+        returns lines of text.
+        '''
+        state = self.getState()
+
+        r = ['metrics of the last {:.0f} s'.format(state['duration']), '']
+
+        histograms = state['histograms']
+        if len(histograms) != 0:
+            r.append('{:<40} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('histogram', 'count', 'mean ms', 'p50 ms',
+                                                                       'p99 ms', 'max ms'))
+            for name in sorted(histograms):
+                x = histograms[name]
+                r.append('{:<40} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                    name, x['count'], 1000 * x['sum'] / x['count'], 1000 * x['p50'], 1000 * x['p99'], 1000 * x['max']))
+            r.append('')
+
+        counters = state['counters']
+        if len(counters) != 0:
+            r.append('{:<40} {:>8}'.format('counter', 'value'))
+            r.extend('{:<40} {:>8}'.format(name, counters[name]) for name in sorted(counters))
+            r.append('')
+
+        gauges = state['gauges']
+        if len(gauges) != 0:
+            r.append('{:<40} {:>8} {:>10}'.format('gauge', 'last', 'max'))
+            r.extend('{:<40} {:>8} {:>10}'.format(name, gauges[name]['last'], gauges[name]['max'])
+                     for name in sorted(gauges))
+
+        return r
+
+    def dump(self, path=None):
+        '''
+        writes getState to path (default: getDefaultPath) as json.
+        '''
+        import json
+
+        if path is None:
+            path = getDefaultPath()
+        directory = os.path.dirname(path)
+        if len(directory) != 0:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(path, 'w') as f:
+            json.dump(self.getState(), f, indent=1, sort_keys=True)
+        return path
+
+
+Active = None  # Metrics
+
+
+def enable():
+    '''
+    returns Active, creates it if necessary.
+    '''
+    global Active
+    if Active is None:
+        Active = Metrics()
+    return Active
+
+
+def disable():
+    global Active
+    Active = None
@@ -1,37 +1,166 @@
 # -*- coding: utf-8 -*-
 
 import ranger.api.commands as commands
+import ranger.core.loader as loader
 from . import parasail
+from . import index
+import shared.instrument as instrument
+
+import os
+import time
+
+
+CATCH_ALL = '\x7f'
+
+
+def _superAlphabet():
+    '''
+    returns printable ascii and CATCH_ALL, see fold.
+
+    parasail's profile grows with the alphabet: ~14 us per item with these 96 characters,
+    ~38 us with all 255 latin-1 characters.
+    '''
+    return ''.join(map(chr, range(0x20, 0x7f))) + CATCH_ALL
+
+
+class _FoldTable(dict):
+    def __missing__(self, i):
+        return ord(CATCH_ALL)
+
+
+_FOLD_TABLE = _FoldTable((i, i) for i in range(0x20, 0x7f))
+
+
+def fold(s):
+    '''
+    returns s with every character not in _superAlphabet replaced by CATCH_ALL.
+
+    so non-ascii characters match each other, and parasail (latin-1) can encode every string.
+    '''
+    if s.isascii() and s.isprintable():
+        return s
+    return s.translate(_FOLD_TABLE)
+
+
+class ScoreCache:
+    '''
+    LRU cache of scores.
+
+    keys are (ref, s, ignoreCase).
+    '''
+
+    OrderedDict = None
+    Threading = None
+
+    def __init__(self, maxSize=2 ** 20):
+        if ScoreCache.OrderedDict is None:
+            import collections
+            ScoreCache.OrderedDict = collections.OrderedDict
+            import threading
+            ScoreCache.Threading = threading
+
+        self.MaxSize = maxSize
+
+        self._Items = ScoreCache.OrderedDict()
+        self._Lock = ScoreCache.Threading.Lock()  # see Ranking
+
+    def get(self, key):
+        '''
+        returns the score or None.
+        '''
+        items = self._Items
+        with self._Lock:
+            r = items.get(key)
+            if r is not None:
+                items.move_to_end(key)
+        return r
+
+    def put(self, key, score):
+        items = self._Items
+        with self._Lock:
+            items[key] = score
+            if self.MaxSize < len(items):
+                items.popitem(last=False)
+
+    def clear(self):
+        with self._Lock:
+            self._Items.clear()
+
+    def __len__(self):
+        return len(self._Items)
+
+
+ScoreCaches = None  # path: ScoreCache
+MAX_SCORE_CACHES = 4
+
+
+def getScoreCache(path):
+    '''
+    returns the ScoreCache of directory path.
+
+    keeps at most MAX_SCORE_CACHES caches.
+    '''
+    global ScoreCaches
+    if ScoreCaches is None:
+        ScoreCaches = ScoreCache(maxSize=MAX_SCORE_CACHES)
+
+    r = ScoreCaches.get(path)
+    if r is None:
+        r = ScoreCache()
+        ScoreCaches.put(path, r)
+    return r
 
 
 class SwSortKey:
+    '''
+    matches sort item to ref.
+
+    the match matrix is created once from a fixed alphabet (see _superAlphabet), strings are folded to it.
+    if Cache is set, scores are looked up there first.
+    '''
+
+    MatchMatrices = {}  # (match score, mismatch score): matrix
+
     def __init__(self):
-        self.Alphabet = set()
         self.MatchScore = 2
         self.MismatchScore = -1
         self.GapOpen = 2
         self.GapExtend = 0
-        self.MatchMatrix = None
 
         self.Ref = None
+        self.IgnoreCase = False
+        self.Cache = None
+
+    @property
+    def MatchMatrix(self):
+        key = (self.MatchScore, self.MismatchScore)
+        r = SwSortKey.MatchMatrices.get(key)
+        if r is None:
+            r = parasail.matrix_create(_superAlphabet(), self.MatchScore, self.MismatchScore)
+            SwSortKey.MatchMatrices[key] = r
+        return r
 
     def setRef(self, ref):
         self.Ref = ref
-        self._addToAlphabet(ref)
 
     def __call__(self, s):
-        self._addToAlphabet(s)
-        r = parasail.sw_striped_16(s, self.Ref, self.GapOpen, self.GapExtend, self.MatchMatrix)
-        return r.score + 1 / len(s)
-
-    def _addToAlphabet(self, x):
-        chars = set(x)
-        newChars = chars - self.Alphabet
-        if len(newChars) == 0:
-            return
+        return self.score(self.Ref, s)
+
+    def score(self, ref, s):
+        cache = self.Cache
+        if cache is None:
+            return self._score(ref, s)
+
+        key = (ref, s, self.IgnoreCase)
+        r = cache.get(key)
+        if r is None:
+            r = self._score(ref, s)
+            cache.put(key, r)
+        return r
 
-        self.Alphabet.update(newChars)
-        self.MatchMatrix = parasail.matrix_create(''.join(self.Alphabet), self.MatchScore, self.MismatchScore)
+    def _score(self, ref, s):
+        r = parasail.sw_striped_16(fold(s), fold(ref), self.GapOpen, self.GapExtend, self.MatchMatrix)
+        return r.score + 1 / len(s)
 
 
 class SwSplitApplySortKey(SwSortKey):
@@ -40,6 +169,9 @@ class SwSplitApplySortKey(SwSortKey):
     - applies applyF to sort item
     - matches new sort item to all parts of ref
     - returns sum of scores
+
+    parts are scored (and cached) separately.
+    so if the query is extended, only the changed part is scored again.
     '''
 
     def __init__(self, splitBy=None, applyF=lambda item: item):
@@ -52,27 +184,295 @@ class SwSplitApplySortKey(SwSortKey):
 
     def setRef(self, ref):
         self.Ref = ref
-        self._Refs = refs = ref.split(self.SplitBy)
-        for ref in refs:
-            self._addToAlphabet(ref)
+        self._Refs = ref.split(self.SplitBy)
 
     def __call__(self, x):
-        refBak = self.Ref
-
         x = self.ApplyF(x)
+        return sum(self.score(ref, x) for ref in self._Refs)
+
+    def getUpperDelta(self, previous):
+        '''
+        returns d such that previous(x) <= self(x) <= previous(x) + d for every x, or None.
+
+        requires the ref of self to extend the ref of previous.
+        appending a character raises a part's score by at most MatchScore, a new part adds at most
+        MatchScore per character and 1 (see _score).
+        '''
+        if (self.IgnoreCase, self.MatchScore, self.MismatchScore, self.GapOpen, self.GapExtend) != \
+                (previous.IgnoreCase, previous.MatchScore, previous.MismatchScore, previous.GapOpen,
+                 previous.GapExtend):
+            return None
+
+        refs = self._Refs
+        previousRefs = previous._Refs
+        n = len(previousRefs)
+        if len(refs) < n:
+            return None
+
         r = 0
+        if n != 0:
+            if refs[:n - 1] != previousRefs[:n - 1] or not refs[n - 1].startswith(previousRefs[n - 1]):
+                return None
+            r += self.MatchScore * (len(refs[n - 1]) - len(previousRefs[n - 1]))
+
+        for ref in refs[n:]:
+            r += self.MatchScore * len(ref) + 1
+        return r
+
+
+Executor = None
+BATCH_SIZE = 1024
+
+
+def getExecutor():
+    '''
+    returns the thread pool used by Ranking.
+
+    parasail is called through ctypes which releases the GIL, so threads score in parallel.
+    '''
+    global Executor
+    if Executor is None:
+        import concurrent.futures as futures
+        Executor = futures.ThreadPoolExecutor()
+    return Executor
+
+
+class Ranking:
+    '''
+    scores items in batches using getExecutor and selects the k best items.
+
+    if prefilterF is not None, items are replaced by prefilterF(items) first.
+    if bounds is not None, it is (lower bounds, upper bounds) of the scores and only items
+    which may be among the k best are scored, see _getIndices.
+    sortKey must not be modified while running.
+    '''
+
+    Futures = None
+    Heapq = None
+
+    def __init__(self, items, sortKey, k=None, batchSize=BATCH_SIZE, prefilterF=None, bounds=None):
+        if Ranking.Futures is None:
+            import concurrent.futures as futures
+            Ranking.Futures = futures
+            import heapq
+            Ranking.Heapq = heapq
+
+        self.Items = items
+        self.SortKey = sortKey
+        self.K = k
+        self.BatchSize = batchSize
+        self.PrefilterF = prefilterF
+        self.Bounds = bounds
+
+        self.Cancelled = False
+        self.Lowers = None  # bounds of the scores of the result, see _select
+        self.Uppers = None
+
+        self._Indices = None  # of the items to score
+        self._Futures = None
+
+    def prefilter(self):
+        prefilterF = self.PrefilterF
+        if prefilterF is None:
+            return
+        self.PrefilterF = None
+
+        metrics = instrument.Active
+        if metrics is None:
+            self.Items = prefilterF(self.Items)
+            return
 
+        t = time.perf_counter()
+        self.Items = prefilterF(self.Items)
+        metrics.add('sw.prefilter', time.perf_counter() - t)
+
+    def _getIndices(self):
+        '''
+        returns the indices of the items to score.
+
+        items whose upper bound is below the k-th largest lower bound can't be among the k best.
+        '''
+        n = len(self.Items)
+        k = self.K
+        if self.Bounds is None or k is None or k == 0 or n <= k:
+            return range(n)
+
+        lowers, uppers = self.Bounds
+        threshold = Ranking.Heapq.nlargest(k, lowers)[-1]
+        return [i for i, upper in enumerate(uppers) if threshold <= upper]
+
+    def start(self):
+        self.prefilter()
+
+        executor = getExecutor()
+        self._Indices = self._getIndices()
+        n = len(self._Indices)
+        self._Futures = [executor.submit(self._scoreBatch, i, min(i + self.BatchSize, n))
+                         for i in range(0, n, self.BatchSize)]
+
+    def _scoreBatch(self, start, stop):
+        items = self.Items
+        sortKey = self.SortKey
+
+        metrics = instrument.Active
+        if metrics is not None:
+            t = time.perf_counter()
+
+        r = []
+        for i in self._Indices[start:stop]:
+            if self.Cancelled:
+                return None
+            r.append(sortKey(items[i]))
+
+        if metrics is not None and start != stop:
+            metrics.add('sw.score item', (time.perf_counter() - t) / (stop - start), count=stop - start)
+        return r
+
+    def wait(self, timeout=None):
+        '''
+        returns True if all batches are scored.
+        '''
+        notDone = Ranking.Futures.wait(self._Futures, timeout=timeout).not_done
+        return len(notDone) == 0
+
+    def getPercent(self):
+        if len(self._Futures) == 0:
+            return 100
+        return 100 * sum(future.done() for future in self._Futures) // len(self._Futures)
+
+    def cancel(self):
+        self.Cancelled = True
+        if self._Futures is not None:
+            for future in self._Futures:
+                future.cancel()
+
+    def run(self):
+        '''
+        scores synchronously.
+        '''
+        self.prefilter()
+
+        self._Futures = []
+        self._Indices = self._getIndices()
+        return self._select(self._scoreBatch(0, len(self._Indices)))
+
+    def result(self):
+        '''
+        returns the k best items in order followed by the other items in original order.
+        '''
+        scores = []
+        for future in self._Futures:
+            scores.extend(future.result())
+        return self._select(scores)
+
+    def _select(self, scores):
+        '''
+        scores are those of the items at _Indices.
+
+        sets Lowers and Uppers in the order of the result.
+        '''
+        items = self.Items
+        if self.Bounds is None:
+            lowers = uppers = scores
+        else:
+            lowers = list(self.Bounds[0])
+            uppers = list(self.Bounds[1])
+            for i, score in zip(self._Indices, scores):
+                lowers[i] = uppers[i] = score
+
+        # items not scored can't beat the k-th best score with their upper bound
+        k = len(items) if self.K is None else self.K
+        top = Ranking.Heapq.nlargest(k, range(len(items)), key=uppers.__getitem__)
+
+        topSet = set(top)
+        order = top + [i for i in range(len(items)) if i not in topSet]
+        self.Lowers = [lowers[i] for i in order]
+        self.Uppers = [uppers[i] for i in order]
+        return [items[i] for i in order]
+
+
+class RankingLoader(loader.Loadable):
+    '''
+    runs a Ranking in the background and calls applyF with its result.
+
+    clears sw_nav.ActiveLoader when done.
+    '''
+
+    def __init__(self, ranking, applyF):
+        self.Ranking = ranking
+        self.ApplyF = applyF
+
+        super().__init__(self.generate(), 'sw_nav: ranking')
+
+    def generate(self):
         try:
-            for ref in self._Refs:
-                self.Ref = ref
-                r += super().__call__(x)
+            yield from self._generate()
         finally:
-            self.Ref = refBak
+            self._deactivate()
 
-        return r
+    def _generate(self):
+        ranking = self.Ranking
+        start = time.perf_counter()
+
+        if ranking.PrefilterF is not None:
+            future = getExecutor().submit(ranking.prefilter)
+            while not Ranking.Futures.wait([future], timeout=0.005).done:
+                yield
+            future.result()
+
+            if ranking.Cancelled:
+                return
+
+        ranking.start()
+
+        # don't spin within Loader.work
+        while not ranking.wait(timeout=0.005):
+            if ranking.Cancelled:
+                return
+            self.percent = ranking.getPercent()
+            yield
+
+        if ranking.Cancelled:
+            return
+        self.ApplyF(ranking.result())
+
+        metrics = instrument.Active
+        if metrics is not None:
+            metrics.add('sw.rank background', time.perf_counter() - start)
+
+    def _deactivate(self):
+        if sw_nav.ActiveLoader is self:
+            sw_nav.ActiveLoader = None
+
+    def destroy(self):
+        self.Ranking.cancel()
+        self._deactivate()
+
+
+IndexLoaders = {}  # root: IndexLoader
+
+
+class IndexLoader(loader.Loadable):
+    '''
+    runs index.PathIndex.update in the background.
+
+    calls DoneF when done, if not None.
+    '''
+
+    def __init__(self, pathIndex):
+        self.PathIndex = pathIndex
+        self.DoneF = None
+
+        super().__init__(self.generate(), 'sw_nav: indexing {}'.format(pathIndex.Root))
 
+    def generate(self):
+        try:
+            yield from self.PathIndex.update()
+        finally:
+            IndexLoaders.pop(self.PathIndex.Root, None)
 
-sortKey = SwSplitApplySortKey()
+        if self.DoneF is not None:
+            self.DoneF()
 
 
 class sw_nav(commands.Command):
@@ -81,6 +481,24 @@ class sw_nav(commands.Command):
     KEEP_OPEN = 'k'
     SMART_CASE = 's'
     OPEN_ON_TAB = 't'
+    RECURSIVE = 'r'
+
+    # directories with less items are ranked synchronously
+    BACKGROUND_THRESHOLD = 5000
+    # number of best items put in order; None for (twice) the terminal height
+    TOP_K = None
+    # number of best paths to cycle through in recursive mode
+    RECURSIVE_TOP_K = 100
+
+    ActiveLoader = None
+    # (items, sortKey, lower bounds, upper bounds) of the last ranking in the current directory,
+    # see SwSplitApplySortKey.getUpperDelta
+    Previous = None
+
+    # recursive mode
+    Root = None
+    Results = []
+    Position = 0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -88,9 +506,23 @@ class sw_nav(commands.Command):
         self.Flags, self.Ref = self.parse_flags()
 
     def quick(self):
+        self._cancelRanking()
+
         ignoreCase = sw_nav.IGNORE_CASE in self.Flags or (sw_nav.SMART_CASE in self.Flags and self.Ref.islower())
 
-        # modify global key
+        # a new key for each query, a Ranking may still use the previous one
+        sortKey = SwSplitApplySortKey()
+        sortKey.IgnoreCase = ignoreCase
+
+        if sw_nav.RECURSIVE in self.Flags:
+            if ignoreCase:
+                sortKey.setRef(self.Ref.lower())
+                sortKey.ApplyF = str.lower
+            else:
+                sortKey.setRef(self.Ref)
+            self._quickRecursive(sortKey)
+            return False
+
         if ignoreCase:
             sortKey.setRef(self.Ref.lower())
             sortKey.ApplyF = lambda item: item.relative_path_lower
@@ -98,27 +530,152 @@ class sw_nav(commands.Command):
             sortKey.setRef(self.Ref)
             sortKey.ApplyF = lambda item: item.relative_path
 
-        # force sort
         thisdir = self.fm.thisdir
-        thisdir.files_all.sort(key=sortKey, reverse=True)
-        thisdir.refilter()
-        thisdir.move(to=0)
+        sortKey.Cache = getScoreCache(thisdir.path)
+
+        filesAll = thisdir.files_all
+        if filesAll is None:
+            return False
+
+        items = list(filesAll)
+        ranking = Ranking(items, sortKey, k=self._getTopK(), bounds=self._getBounds(items, sortKey))
+
+        def apply(items):
+            if thisdir.files_all is not filesAll:  # reloaded in the meantime
+                return
+            filesAll[:] = items
+            thisdir.refilter()
+            thisdir.move(to=0)
+
+            sw_nav.Previous = (items, sortKey, ranking.Lowers, ranking.Uppers)
+
+        if len(filesAll) < sw_nav.BACKGROUND_THRESHOLD:
+            start = time.perf_counter()
+            apply(ranking.run())
+
+            metrics = instrument.Active
+            if metrics is not None:
+                metrics.add('sw.rank', time.perf_counter() - start)
+            return False
+
+        sw_nav.ActiveLoader = rankingLoader = RankingLoader(ranking, apply)
+        self.fm.loader.add(rankingLoader)
 
         return False
 
+    def _getBounds(self, items, sortKey):
+        '''
+        returns the bounds of the scores if the query extends the previous one, see Ranking.
+        '''
+        previous = sw_nav.Previous
+        if previous is None:
+            return None
+
+        previousItems, previousSortKey, lowers, uppers = previous
+        if len(previousItems) != len(items) or any(a is not b for a, b in zip(previousItems, items)):
+            return None
+
+        delta = sortKey.getUpperDelta(previousSortKey)
+        if delta is None:
+            return None
+        return (lowers, [upper + delta for upper in uppers])
+
+    def _quickRecursive(self, sortKey):
+        '''
+        ranks the paths below the root (the initial directory) and selects the best one.
+
+        only paths passing index.PathIndex.filter are scored.
+        the index is updated once per search.
+        '''
+        root = sw_nav.Root
+        pathIndex = index.getPathIndex(self.fm.thisdir.path if root is None else root)
+        if root is None:
+            root = sw_nav.Root = pathIndex.Root
+            pathIndex.Updated = False
+        sortKey.Cache = getScoreCache(root)
+
+        if not pathIndex.Updated:
+            indexLoader = IndexLoaders.get(pathIndex.Root)
+            if indexLoader is None:
+                indexLoader = IndexLoaders[pathIndex.Root] = IndexLoader(pathIndex)
+                self.fm.loader.add(indexLoader, append=True)
+
+            # results may be missing or outdated until then
+            indexLoader.DoneF = lambda: self._requery(root)
+
+        refs = self.Ref.split()
+        ranking = Ranking(pathIndex, sortKey, k=sw_nav.RECURSIVE_TOP_K,
+                          prefilterF=lambda pathIndex: pathIndex.filter(refs))
+
+        def apply(paths):
+            sw_nav.Results = paths[:sw_nav.RECURSIVE_TOP_K]
+            sw_nav.Position = 0
+            self._selectResult()
+
+        sw_nav.ActiveLoader = rankingLoader = RankingLoader(ranking, apply)
+        self.fm.loader.add(rankingLoader)
+
+    def _requery(self, root):
+        '''
+        ranks again if the recursive search in root is still active.
+        '''
+        if sw_nav.Root == root:
+            self.quick()
+
+    def _selectResult(self):
+        results = sw_nav.Results
+        if len(results) == 0:
+            return
+
+        path = results[sw_nav.Position % len(results)]
+        self.fm.select_file(os.path.join(sw_nav.Root, path))
+
+    def _getTopK(self):
+        if sw_nav.TOP_K is not None:
+            return sw_nav.TOP_K
+
+        termsize = getattr(self.fm.ui, 'termsize', None)
+        if termsize is None:
+            return None
+        return 2 * termsize[0]
+
+    def _cancelRanking(self, complete=False):
+        '''
+        if complete: waits for the active ranking and applies it.
+        '''
+        rankingLoader = sw_nav.ActiveLoader
+        if rankingLoader is None:
+            return
+        sw_nav.ActiveLoader = None
+
+        # Loader.work drops the generator of a finished loader
+        if complete and rankingLoader.load_generator is not None:
+            for _ in rankingLoader.load_generator:
+                pass
+
+        rankingLoader.destroy()
+        self.fm.loader.remove(item=rankingLoader)
+
     def tab(self, tabnum):
         if sw_nav.OPEN_ON_TAB in self.Flags:
-            self._finish()
+            self._finish(complete=True)
             self._open()
             return
 
+        if sw_nav.RECURSIVE in self.Flags:
+            sw_nav.Position += tabnum
+            self._selectResult()
+            return
+
         self.fm.thisdir.move(down=tabnum)
 
     def execute(self):
         if sw_nav.OPEN_ON_ENTER not in self.Flags:
+            self._cancelRanking(complete=True)
+            self._reset()
             return
 
-        self._finish()
+        self._finish(complete=True)
         self._open()
 
     def _open(self):
@@ -134,8 +691,21 @@ class sw_nav(commands.Command):
         self.fm.open_console(line)
 
     def cancel(self):
+        root = sw_nav.Root
         self._finish()
 
-    def _finish(self):
+        if root is not None:
+            self.fm.cd(root)
+
+    def _finish(self, complete=False):
+        self._cancelRanking(complete=complete)
+        self._reset()
+
         thisdir = self.fm.thisdir
         thisdir.sort()
+
+    def _reset(self):
+        sw_nav.Root = None
+        sw_nav.Results = []
+        sw_nav.Position = 0
+        sw_nav.Previous = None
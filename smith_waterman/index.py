@@ -0,0 +1,367 @@
+'''
+persistent index of all paths below a root directory.
+
+the index file is memory mapped and consists of
+- header: number of paths n, number of path bytes
+- offsets: n + 1 uint64, path i is paths[offsets[i]:offsets[i + 1]]
+- masks: n uint64, see getMask
+- paths: utf-8 encoded paths relative to root, those of a directory are contiguous
+
+the dirs file (pickle) keeps the mtime, the range of entries in the index file and the names of the sub
+directories of each directory, so unchanged directories are neither listed nor decoded again.
+
+requires numpy (a dependency of parasail).
+'''
+
+import os
+import struct
+
+HEADER = struct.Struct('QQ')
+DIRS_VERSION = 2
+FILTER_CHUNK_SIZE = 2 ** 20  # paths
+
+
+def _getBit(c):
+    '''
+    a-z, 0-9: one bit each, other characters share the remaining bits.
+    '''
+    if 'a' <= c <= 'z':
+        return 1 << (ord(c) - ord('a'))
+    if '0' <= c <= '9':
+        return 1 << (26 + ord(c) - ord('0'))
+    return 1 << (36 + ord(c) % 28)
+
+
+_Bits = {}  # char: bit
+
+
+def getMask(s):
+    '''
+    returns the bitmask of characters in s, ignoring case.
+    '''
+    r = 0
+    for c in set(s.lower()):
+        bit = _Bits.get(c)
+        if bit is None:
+            bit = _Bits[c] = _getBit(c)
+        r |= bit
+    return r
+
+
+try:
+    _popcount = int.bit_count
+except AttributeError:  # python < 3.10
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+_BitCounts = None  # numpy array, bits of each byte
+
+
+def _popcounts(np, x):
+    '''
+    returns the number of bits of each uint64 in x.
+    '''
+    bitwise_count = getattr(np, 'bitwise_count', None)
+    if bitwise_count is not None:  # numpy >= 2
+        return bitwise_count(x)
+
+    global _BitCounts
+    if _BitCounts is None:
+        _BitCounts = np.array([_popcount(i) for i in range(256)], dtype=np.uint8)
+    return _BitCounts[x.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def getDefaultDirectory():
+    cacheHome = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheHome, 'ranger-ext', 'sw_index')
+
+
+class PathIndex:
+    '''
+    index of paths below root.
+
+    see update and filter.
+    '''
+
+    Pickle = None
+    Numpy = None
+    Futures = None
+
+    # names of directories that are not indexed
+    Exclude = frozenset(['.git', '.hg', '.svn'])
+
+    def __init__(self, root, directory=None):
+        if PathIndex.Pickle is None:
+            import pickle
+            PathIndex.Pickle = pickle
+            import numpy
+            PathIndex.Numpy = numpy
+            import concurrent.futures as futures
+            PathIndex.Futures = futures
+
+        self.Root = root = os.path.abspath(root)
+        if directory is None:
+            directory = getDefaultDirectory()
+
+        import hashlib
+        name = hashlib.sha1(os.fsencode(root)).hexdigest()
+        self.Path = os.path.join(directory, name)
+        self.DirsPath = self.Path + '.dirs'
+
+        self.Updated = False  # set by update, reset to update again
+
+        self._Dirs = None  # relative path: (mtime_ns, start, stop, names of sub directories)
+        self._Map = None
+        self._Offsets = None  # numpy arrays
+        self._Masks = None
+        self._Paths = None  # memoryview
+
+    def load(self):
+        '''
+        maps the index file if it exists.
+        '''
+        try:
+            f = open(self.Path, 'rb')
+        except FileNotFoundError:
+            return False
+
+        import mmap
+        with f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return False
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # previous views are not released explicitly, a running filter may still use them
+        np = PathIndex.Numpy
+        n, size = HEADER.unpack_from(m)
+        i = HEADER.size
+        self._Offsets = np.frombuffer(m, dtype=np.uint64, count=n + 1, offset=i)
+        i += 8 * (n + 1)
+        self._Masks = np.frombuffer(m, dtype=np.uint64, count=n, offset=i)
+        i += 8 * n
+        self._Paths = memoryview(m)[i:i + size]
+        self._Map = m
+        return True
+
+    def __len__(self):
+        masks = self._Masks
+        return 0 if masks is None else len(masks)
+
+    def getPath(self, i):
+        offsets = self._Offsets
+        return os.fsdecode(bytes(self._Paths[int(offsets[i]):int(offsets[i + 1])]))
+
+    def update(self):
+        '''
+        generator, yields after each directory and while the index file is written.
+
+        directories with unchanged mtime are not listed again.
+        rewrites the index file in a thread if anything changed.
+        '''
+        if self._Dirs is None:
+            self._Dirs = self._loadDirs()
+
+        oldDirs = self._Dirs
+        old = (self._Offsets, self._Masks, self._Paths)
+        dirs = {}  # relative path: (mtime_ns, names of sub directories, (names, masks) or None if unchanged)
+        changed = False
+
+        stack = ['']
+        while len(stack) != 0:
+            rel = stack.pop()
+            path = os.path.join(self.Root, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+
+            entry = oldDirs.get(rel)
+            if entry is None or entry[0] != mtime:
+                subdirs, names, masks = self._scanDir(path)
+                dirs[rel] = (mtime, subdirs, (names, masks))
+                changed = True
+            else:
+                subdirs = entry[3]
+                dirs[rel] = (mtime, subdirs, None)
+
+            stack.extend(os.path.join(rel, name) for name in subdirs)
+
+            yield
+
+        if changed or dirs.keys() != oldDirs.keys():
+            # off the calling (ui) thread
+            with PathIndex.Futures.ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(self._write, dirs, oldDirs, old)
+                while not PathIndex.Futures.wait([future], timeout=0.005).done:
+                    yield
+                self._Dirs = future.result()
+            self.load()
+
+        self.Updated = True
+
+    def _scanDir(self, path):
+        '''
+        returns (names of sub directories, names, masks).
+        '''
+        subdirs = []
+        names = []
+        masks = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        isDir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        isDir = False
+                    if isDir:
+                        if entry.name in PathIndex.Exclude:
+                            continue
+                        subdirs.append(entry.name)
+
+                    names.append(entry.name)
+                    masks.append(getMask(entry.name))
+        except OSError:
+            pass
+
+        return (subdirs, names, masks)
+
+    def _loadDirs(self):
+        '''
+        returns {} unless the dirs file matches the index file.
+        '''
+        try:
+            with open(self.DirsPath, 'rb') as f:
+                x = PathIndex.Pickle.load(f)
+        except (OSError, EOFError, PathIndex.Pickle.UnpicklingError):
+            return {}
+
+        if not isinstance(x, dict) or x.get('version') != DIRS_VERSION or x.get('count') != len(self):
+            return {}
+        return x['dirs']
+
+    def _write(self, dirs, oldDirs, old):
+        '''
+        entries of unchanged directories are copied from old (offsets, masks, paths).
+
+        returns the new dirs, see _Dirs.
+        '''
+        np = PathIndex.Numpy
+        oldOffsets, oldMasks, oldPaths = old
+
+        offsetParts = [np.zeros(1, dtype=np.uint64)]
+        maskParts = [np.zeros(0, dtype=np.uint64)]
+        pathParts = []
+        newDirs = {}
+        n = 0
+        size = 0
+
+        for rel, (mtime, subdirs, scan) in dirs.items():
+            if scan is None:
+                _, start, stop, _ = oldDirs[rel]
+                a = int(oldOffsets[start])
+                b = int(oldOffsets[stop])
+                offsetParts.append(oldOffsets[start + 1:stop + 1] - np.uint64(a) + np.uint64(size))
+                maskParts.append(oldMasks[start:stop])
+                pathParts.append(oldPaths[a:b])
+                count = stop - start
+                size += b - a
+
+            else:
+                names, masks = scan
+                paths = [os.fsencode(os.path.join(rel, name)) for name in names]
+                lengths = np.fromiter(map(len, paths), dtype=np.uint64, count=len(paths))
+                offsetParts.append(np.cumsum(lengths, dtype=np.uint64) + np.uint64(size))
+                maskParts.append(np.array(masks, dtype=np.uint64) | np.uint64(getMask(rel)))
+                path = b''.join(paths)
+                pathParts.append(path)
+                count = len(names)
+                size += len(path)
+
+            newDirs[rel] = (mtime, n, n + count, subdirs)
+            n += count
+
+        os.makedirs(os.path.dirname(self.Path), exist_ok=True)
+
+        # index file first, a mismatching dirs file is ignored, see _loadDirs
+        tmpPath = self.Path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(HEADER.pack(n, size))
+            f.write(np.concatenate(offsetParts).tobytes())
+            f.write(np.concatenate(maskParts).tobytes())
+            for path in pathParts:
+                f.write(path)
+        os.replace(tmpPath, self.Path)
+
+        tmpPath = self.DirsPath + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            PathIndex.Pickle.dump({'version': DIRS_VERSION, 'count': n, 'dirs': newDirs}, f,
+                                  protocol=PathIndex.Pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, self.DirsPath)
+
+        return newDirs
+
+    def filter(self, refs, minRatio=0.75, maxCount=10000):
+        '''
+        returns paths which contain at least minRatio of the characters of each ref.
+
+        returns at most maxCount paths, those with most characters in common.
+        numpy releases the GIL, so filtering in a thread doesn't block the ui.
+        '''
+        # update may load a new index file in the meantime
+        offsets = self._Offsets
+        masks = self._Masks
+        paths = self._Paths
+        if masks is None or len(masks) == 0 or len(refs) == 0:
+            return []
+
+        import math
+        np = PathIndex.Numpy
+
+        refMasks = [np.uint64(getMask(ref)) for ref in refs]
+        mins = [math.ceil(minRatio * _popcount(getMask(ref))) for ref in refs]
+
+        indices = []
+        totals = []
+        for start in range(0, len(masks), FILTER_CHUNK_SIZE):
+            chunk = masks[start:start + FILTER_CHUNK_SIZE]
+            keep = None
+            total = None
+            for refMask, min_ in zip(refMasks, mins):
+                overlap = _popcounts(np, chunk & refMask)
+                if keep is None:
+                    keep = min_ <= overlap
+                    total = overlap.astype(np.uint32)
+                else:
+                    keep &= min_ <= overlap
+                    total += overlap
+
+            i = np.flatnonzero(keep)
+            indices.append(i + start)
+            totals.append(total[i])
+
+        indices = np.concatenate(indices)
+        if maxCount < len(indices):
+            totals = np.concatenate(totals)
+            indices = indices[np.argpartition(totals, len(totals) - maxCount)[len(totals) - maxCount:]]
+
+        starts = offsets[indices].tolist()
+        stops = offsets[indices + 1].tolist()
+        fsdecode = os.fsdecode
+        return [fsdecode(bytes(paths[a:b])) for a, b in zip(starts, stops)]
+
+
+PathIndexes = {}  # root: PathIndex
+
+
+def getPathIndex(root):
+    '''
+    returns the loaded PathIndex of root.
+    '''
+    root = os.path.abspath(root)
+    r = PathIndexes.get(root)
+    if r is None:
+        r = PathIndexes[root] = PathIndex(root)
+        r.load()
+    return r
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'external'))
+
+import fastcopy  # noqa: E402
+
+
+def _run(f, timeout=10):
+    '''
+    returns the exception f raised, fails if f blocks.
+    '''
+    r = []
+
+    def target():
+        try:
+            f()
+        except Exception as e:
+            r.append(e)
+        else:
+            r.append(None)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert len(r) != 0, 'blocked'
+    return r[0]
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='requires os.mkfifo')
+def test_fifo(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'file').write_bytes(b'x' * 1000)
+    os.mkfifo(str(src / 'fifo'))
+
+    e = _run(lambda: list(fastcopy.copy2(str(src / 'fifo'), str(tmp_path / 'fifo'), overwrite=True)))
+    assert isinstance(e, shutil.SpecialFileError)
+
+    e = _run(lambda: list(fastcopy.copytree(str(src), str(tmp_path / 'dst'))))
+    assert isinstance(e, shutil.Error)
+    assert [x[0] for x in e.args[0]] == [str(src / 'fifo')]
+    assert (tmp_path / 'dst' / 'file').read_bytes() == b'x' * 1000
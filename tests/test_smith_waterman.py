@@ -0,0 +1,100 @@
+'''
+requires ranger and parasail, see smith_waterman/setup_parasail.sh.
+'''
+
+import os
+
+import pytest
+
+sw = pytest.importorskip('smith_waterman')
+
+
+class Loader:
+    '''
+    runs loadables like ranger.core.loader.Loader.work, to completion.
+    '''
+
+    def __init__(self):
+        self.Queue = []
+
+    def add(self, item, append=False):
+        self.Queue.append(item)
+
+    def remove(self, item=None):
+        if item in self.Queue:
+            item.destroy()
+            self.Queue.remove(item)
+
+    def run(self):
+        while len(self.Queue) != 0:
+            item = self.Queue[0]
+            for _ in item.load_generator:
+                pass
+            item.load_generator = None
+            self.Queue.remove(item)
+
+
+class Dir:
+    def __init__(self, path):
+        self.path = path
+
+
+class Fm:
+    def __init__(self, path):
+        self.loader = Loader()
+        self.thisdir = Dir(path)
+        self.Selected = None
+
+    def select_file(self, path):
+        self.Selected = path
+
+
+@pytest.fixture
+def fm(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(sw.index, 'PathIndexes', {})
+    for name in ['ActiveLoader', 'Previous', 'Root', 'Results', 'Position']:
+        monkeypatch.setattr(sw.sw_nav, name, getattr(sw.sw_nav, name))
+
+    root = tmp_path / 'root'
+    (root / 'sub').mkdir(parents=True)
+    for name in ['alpha.txt', 'beta.txt', 'sub/gamma.txt']:
+        (root / name).write_text('')
+
+    r = Fm(str(root))
+    monkeypatch.setattr(sw.sw_nav, 'fm', r, raising=False)
+    return r
+
+
+def test_execute_after_finished_ranking(fm):
+    sw.sw_nav('sw_nav -r gamma').quick()
+    fm.loader.run()
+
+    assert sw.sw_nav.ActiveLoader is None
+    assert fm.Selected == os.path.join(fm.thisdir.path, 'sub', 'gamma.txt')
+
+    sw.sw_nav('sw_nav -r gamma').execute()
+    assert sw.sw_nav.Root is None
+
+
+def test_index_updated_per_search(fm):
+    sw.sw_nav('sw_nav -r gamma').quick()
+    fm.loader.run()
+    sw.sw_nav('sw_nav -r gamma').execute()
+
+    path = os.path.join(fm.thisdir.path, 'sub', 'delta.txt')
+    open(path, 'w').close()
+
+    sw.sw_nav('sw_nav -r delta').quick()
+    fm.loader.run()
+    assert fm.Selected == path
+
+
+@pytest.mark.parametrize('name', ['日本語.txt', '\U0001f600.txt', os.fsdecode(b'\xff\xfe.txt')])
+def test_non_latin_1(fm, name):
+    path = os.path.join(fm.thisdir.path, 'sub', name)
+    open(path, 'w').close()
+
+    sw.sw_nav('sw_nav -r {}'.format(name)).quick()
+    fm.loader.run()
+    assert fm.Selected == path